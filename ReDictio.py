@@ -21,12 +21,33 @@ gene4   antp
 
 ReDictio can handle this for you!
 
+All the keys of the dictionary are compiled into a single regular expression (built from a trie of the keys),
+so the target file is scanned only once, whatever the number of keys. When several keys match at the same
+position, the longest one wins. Note that replacements are not chained: a replaced string is never matched again.
+
+The target file is streamed in chunks, so files larger than the available memory can be processed. When replacing
+"inplace", the output is written to a temporary file which then atomically replaces the original one.
+
+If your target is a fasta file and you only want to rename its headers, use --fasta_headers: only the header IDs
+are looked up in the dictionary, and sequence lines are copied without being scanned at all.
+
+Several target files (or glob patterns) can be given at once: the dictionary is read and compiled only once,
+and files are processed in parallel.
+
+Compiled dictionaries are cached on disk (by default in ~/.cache/ReDictio), keyed by the content of the dictionary file
+and the replacement mode, so that following runs with the same dictionary can skip the compilation.
+
 Written by: Filippo Nicolini
-Last update: 08/05/2024
+Last update: 18/10/2026
 
 """
 
-import argparse, sys, re
+import argparse, sys, os, re, glob, shutil, tempfile, time, multiprocessing, hashlib, pickle, array, _sre
+
+try:
+    from re import _parser as sre_parser, _compiler as sre_compiler
+except ImportError:
+    import sre_parse as sre_parser, sre_compile as sre_compiler
 
 
 ##########################################
@@ -38,7 +59,8 @@ parser = argparse.ArgumentParser(description = "test")
 
 # Define options/arguments/parameters
 parser.add_argument("-f", "--target_file",
-                    help = "The file where you want to replace strings according to a dictionary.")
+                    nargs = "+",
+                    help = "The file(s) where you want to replace strings according to a dictionary. Several files and/or glob patterns (e.g., \"genomes/*.fasta\", quoted) can be given: the dictionary is read only once and files are processed in parallel.")
 
 parser.add_argument("-d", "--dictionary",
                     help = "The file that is going to be used as a dictionary. The file has to be a tsv file where the first column is the list of strings you want to replace, and the second column the list of the corresponding replacement patterns. REMOVE any header from your dictionary file!")
@@ -51,47 +73,490 @@ parser.add_argument("-i", "--inplace_newFile",
                     choices = ["inplace", "new"],
                     help = "If you want to replace strings in the original file, type \"inplace\". If you want to keep the original file, type \"new\".")
 
+parser.add_argument("--fasta_headers", "--fasta-headers",
+                    action = "store_true",
+                    default = False,
+                    help = "Treat the target file as a fasta file and only replace header IDs (i.e., the first word after \">\") found in the dictionary. Sequence lines are copied as they are. Keys that were never used are written to target_file_unusedKeys.ls. Default: False")
+
+parser.add_argument("-c", "--chunk_size",
+                    type = int,
+                    default = 16,
+                    help = "The target file is streamed in chunks of this many millions of characters, so that memory usage does not depend on its size. Default: 16")
+
+parser.add_argument("-t", "--threads",
+                    type = int,
+                    help = "Number of target files to process in parallel. Default: number of available cores")
+
+parser.add_argument("--cache_dir",
+                    default = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "ReDictio"),
+                    help = "Directory where compiled dictionaries are cached, so that following runs with the same dictionary do not compile it again. Default: ~/.cache/ReDictio")
+
+parser.add_argument("--cache_max_size",
+                    type = int,
+                    default = 2000,
+                    help = "Maximum size of the cache directory, in MB. The least recently used dictionaries are removed first. Default: 2000")
+
+parser.add_argument("--no_cache",
+                    action = "store_true",
+                    default = False,
+                    help = "Do not read nor write the cache of compiled dictionaries. Default: False")
+
 # This line checks if the user gave no arguments, and if so then print the help
 parser.parse_args(args = None if sys.argv[1:] else ["--help"])
 
 # Collect the inputted arguments into a dictionary
 args = parser.parse_args()
 
+# An empty chunk means the end of the file: with -c 0, nothing would be read and the output would be empty
+if args.chunk_size <= 0:
+    parser.error("-c/--chunk_size must be a positive number of millions of characters")
+
+
+############################
+#     Define functions     #
+############################
+
+# Bump this whenever the format of cached dictionaries changes
+CACHE_VERSION = 1
+
+# The ID of a fasta header is everything between ">" and the first whitespace
+FASTA_HEADER_ID = re.compile(rb">(\S*)")
+
+# Function to read in the dictionary file and create a dictionary
+def read_dictionary(dictionary_path):
+    dictionary = {}
+    with open(dictionary_path) as dictionary_file:
+        for line in dictionary_file:
+            if not line.strip():
+                continue
+            fields = line.split("\t")
+            dictionary[fields[0].strip()] = fields[1].strip()
+
+    # Empty keys would match everywhere, so drop them
+    dictionary.pop("", None)
+
+    return dictionary
+
+
+# Function to store all the dictionary keys into a character trie
+def build_trie(keys):
+    trie = {}
+    for key in keys:
+        node = trie
+        for char in key:
+            node = node.setdefault(char, {})
+        # The empty string marks the end of a key
+        node[""] = True
+
+    return trie
+
+
+# Function to convert a trie (or a sub-trie) into a regular expression.
+# Runs of nodes with a single child are collapsed into one literal, and the
+# optional groups are greedy, so at any position the longest key is tried first.
+def trie_to_regex(node):
+    alternatives = []
+    for char in sorted(k for k in node if k):
+        literal = char
+        child = node[char]
+        while len(child) == 1 and "" not in child:
+            (next_char, child), = child.items()
+            literal += next_char
+        alternatives.append(re.escape(literal) + trie_to_regex(child))
+
+    if not alternatives:
+        return ""
+
+    if "" in node:
+        return "(?:" + "|".join(alternatives) + ")?"
+
+    if len(alternatives) == 1:
+        return alternatives[0]
+
+    return "(?:" + "|".join(alternatives) + ")"
+
+
+# Function to compile a single regular expression matching every key of the dictionary.
+# If exact matches are required, keys are replaced only when they are whole words.
+# What is returned are the arguments of the regex engine (i.e., the compiled bytecode), so that they can be
+# cached on disk and turned into a matcher by load_matcher() without compiling the pattern again.
+def compile_matcher(dictionary, exact_matches):
+    pattern = trie_to_regex(build_trie(dictionary))
+
+    if exact_matches:
+        pattern = r"\b(?:" + pattern + r")\b"
+
+    # The internals of the re module may change between Python versions: if anything goes wrong,
+    # only keep the pattern
+    try:
+        parsed = sre_parser.parse(pattern)
+        code = array.array("I", sre_compiler._code(parsed, 0))
+        indexgroup = [None] * parsed.state.groups
+        for name, index in parsed.state.groupdict.items():
+            indexgroup[index] = name
+
+        return (pattern, parsed.state.flags, code, parsed.state.groups - 1, dict(parsed.state.groupdict), tuple(indexgroup))
+
+    except Exception:
+        return (pattern,)
+
+
+# Function to create the matcher out of the output of compile_matcher()
+def load_matcher(matcher_code):
+    pattern = matcher_code[0]
+
+    if len(matcher_code) > 1:
+        try:
+            flags, code, groups, groupindex, indexgroup = matcher_code[1:]
+            return _sre.compile(pattern, flags, code.tolist(), groups, groupindex, indexgroup)
+        except Exception:
+            pass
+
+    return re.compile(pattern)
+
+
+# Function to get the path of the cache file of a dictionary, given the dictionary file and the replacement mode.
+# The key is a hash of the content of the dictionary, so that a modified dictionary is never read from the cache.
+def get_cache_filename(cache_dir, dictionary_path, mode):
+    dictionary_hash = hashlib.sha256()
+    with open(dictionary_path, 'rb') as dictionary_file:
+        for block in iter(lambda: dictionary_file.read(1 << 20), b""):
+            dictionary_hash.update(block)
+
+    # The compiled bytecode is only valid for the Python version that generated it
+    dictionary_hash.update(f"\0{mode}\0{CACHE_VERSION}\0{sys.version}\0{_sre.MAGIC}".encode())
+
+    return f"{cache_dir}/{dictionary_hash.hexdigest()}.pickle"
+
+
+# Function to load a compiled dictionary from the cache. Returns None if it is not there.
+def load_from_cache(cache_filename):
+    try:
+        with open(cache_filename, 'rb') as cache_file:
+            compiled_dictionary = pickle.load(cache_file)
+    except Exception:
+        return None
+
+    # Mark the cache file as recently used; a read-only cache can still be read
+    try:
+        os.utime(cache_filename)
+    except OSError as err:
+        print(f"*** WARNING ***\nCould not update the cache file {cache_filename}: {err}")
+
+    return compiled_dictionary
+
+
+# Function to save a compiled dictionary into the cache, then remove the least recently used
+# cache files until the cache fits in max_size bytes
+def save_to_cache(cache_filename, compiled_dictionary, max_size):
+    cache_dir = os.path.dirname(cache_filename)
+    os.makedirs(cache_dir, exist_ok = True)
+
+    # Write to a temporary file first, so that concurrent runs never read a partial cache file
+    tmp_handle, tmp_filename = tempfile.mkstemp(prefix = ".tmp.", dir = cache_dir)
+    try:
+        with open(tmp_handle, 'wb') as cache_file:
+            pickle.dump(compiled_dictionary, cache_file, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, cache_filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+    cache_files = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".pickle"):
+            cache_files.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+
+    cache_size = sum(size for mtime, size, path in cache_files)
+    for mtime, size, path in sorted(cache_files):
+        if cache_size <= max_size or path == cache_filename:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        cache_size -= size
+
+
+# Function to replace all the dictionary keys while streaming the input file into the output file.
+# Matches can cross chunk boundaries: the last characters of each chunk (as many as the longest key, plus one for
+# word boundaries) are kept back and scanned again together with the following chunk.
+def replace_stream(matcher, dictionary, input_file, output_file, chunk_size):
+    lookahead = max(len(key) for key in dictionary) + 1
+    buffer = ""
+    scan_start = 0
+
+    while True:
+        chunk = input_file.read(chunk_size)
+        buffer += chunk
+        at_end = not chunk
+
+        # Matches starting before this position are the same as in the whole file
+        safe_end = len(buffer) if at_end else len(buffer) - lookahead
+
+        committed = scan_start
+        pieces = []
+        for match in matcher.finditer(buffer, scan_start):
+            if match.start() >= safe_end:
+                break
+            pieces.append(buffer[committed:match.start()])
+            pieces.append(dictionary[match.group(0)])
+            committed = match.end()
+
+        if committed < safe_end:
+            pieces.append(buffer[committed:safe_end])
+            committed = safe_end
+
+        output_file.write("".join(pieces))
+
+        if at_end:
+            break
+
+        # Keep one already written character as left context for word boundaries
+        if committed > 0:
+            buffer = buffer[committed - 1:]
+            scan_start = 1
+
+
+# Function to replace fasta header IDs according to a dictionary of bytes, streaming the input file into the output file.
+# Only header lines are inspected: everything in between is copied as raw bytes.
+# Returns the set of keys that were used.
+def replace_fasta_headers(dictionary, input_file, output_file, chunk_size):
+    used_keys = set()
+
+    # data[start - 1] is the last character before the part of data still to be written
+    # (a virtual newline at the beginning, so that a header on the first line is found as well)
+    data = b"\n"
+    start = 1
+
+    while True:
+        chunk = input_file.read(chunk_size)
+        at_end = not chunk
+        data += chunk
+
+        pos = start - 1
+        pending_header = False
+        while True:
+            header_start = data.find(b"\n>", pos)
+            if header_start == -1:
+                break
+
+            header_end = data.find(b"\n", header_start + 1)
+            if header_end == -1:
+                if not at_end:
+                    pending_header = True
+                    break
+                header_end = len(data)
+
+            output_file.write(data[start:header_start + 1])
+
+            header = data[header_start + 1:header_end]
+            header_id = FASTA_HEADER_ID.match(header).group(1)
+            if header_id in dictionary:
+                used_keys.add(header_id)
+                header = b">" + dictionary[header_id] + header[len(header_id) + 1:]
+            output_file.write(header)
+
+            start = header_end
+            pos = header_end
+
+        if at_end:
+            output_file.write(data[start:])
+            break
+
+        # keep back an incomplete header line, which will be completed by the next chunk
+        if pending_header:
+            output_file.write(data[start:header_start + 1])
+            start = header_start + 1
+        else:
+            output_file.write(data[start:])
+            start = len(data)
+
+        data = data[start - 1:]
+        start = 1
+
+    return used_keys
+
+
+# Function to replace strings in a target file according to the already compiled dictionary.
+# Returns the file name, its size, the time it took and, for fasta headers, the number of used/unused keys.
+def process_target_file(target_filename):
+    start_time = time.perf_counter()
+    file_size = os.path.getsize(target_filename)
+
+    # if "inplace" is chosen, write to a temporary file in the same directory as the original file;
+    # else, create a new file
+    if args.inplace_newFile == "inplace":
+        tmp_handle, outfilename = tempfile.mkstemp(prefix = f".{os.path.basename(target_filename)}.",
+                                                   dir = os.path.dirname(os.path.abspath(target_filename)))
+        os.close(tmp_handle)
+    else:
+        outfilename = f"{target_filename}_replaced"
+
+    # replace according to dictionary, streaming the target file
+    try:
+        if args.fasta_headers:
+            with open(target_filename, 'rb') as target_file, \
+                 open(outfilename, 'wb') as outfile:
+                used_keys = replace_fasta_headers(byte_dictionary, target_file, outfile, args.chunk_size * 1000000)
+        else:
+            with open(target_filename, 'r', newline = "") as target_file, \
+                 open(outfilename, 'w', newline = "") as outfile:
+                replace_stream(matcher, dictionary, target_file, outfile, args.chunk_size * 1000000)
+
+    except BaseException:
+        if args.inplace_newFile == "inplace":
+            os.remove(outfilename)
+        raise
+
+    # atomically replace the original file if "inplace" is chosen, so that a crash can never truncate it
+    if args.inplace_newFile == "inplace":
+        shutil.copymode(target_filename, outfilename)
+        os.replace(outfilename, target_filename)
+
+    # write the keys of the dictionary that were never used
+    unused_filename = None
+    n_used = n_unused = 0
+    if args.fasta_headers:
+        unused_keys = [key for key in byte_dictionary if key not in used_keys]
+        n_used, n_unused = len(used_keys), len(unused_keys)
+
+        if unused_keys:
+            unused_filename = f"{target_filename}_unusedKeys.ls"
+            with open(unused_filename, 'wb') as unused_file:
+                unused_file.writelines(key + b"\n" for key in unused_keys)
+
+    return target_filename, file_size, time.perf_counter() - start_time, n_used, unused_filename, n_unused
+
+
+# Function to process a target file without stopping the other ones if it fails, so that workers are never killed
+# while writing (and always remove their temporary files).
+# Returns the file name, and either the results of process_target_file() or the error.
+def try_process_target_file(target_filename):
+    try:
+        return target_filename, process_target_file(target_filename), None
+    except Exception as err:
+        return target_filename, None, f"{type(err).__name__}: {err}"
+
+
+#------------------------------------------------------------------------------------------
+
 
 #######################
 #     Actual code     #
 #######################
 
-# read in the dictionary file and create a dictionary
-dictionary = {}
-with open(args.dictionary) as dictionary_file:
-    for line in dictionary_file.readlines():
-        dictionary[line.split("\t")[0].strip()] = line.split("\t")[1].strip()
-
-# read in the target file
-with open(args.target_file, 'r') as target_file:
-  filedata = target_file.read()
-
-if args.exact_matches is True:
-    # replace according to dictionary
-    for key in dictionary:    
-        print(f"replaing {key}")
-        replacement = r"\b" + re.escape(key) + r"\b"
-        filedata = re.sub(replacement, dictionary[key], filedata)
+# Any of "True", "true", "yes" or "1" switches on exact matches
+EXACT_MATCHES = str(args.exact_matches).lower() in ("true", "yes", "1")
+
+# the compiled dictionary depends on the replacement mode
+if args.fasta_headers:
+    MODE = "fasta_headers"
+elif EXACT_MATCHES:
+    MODE = "exact_matches"
 else:
-    # replace according to dictionary
-    for key in dictionary:
-        print(f"replacing {key}")
-        replacement = re.escape(key)
-        filedata = re.sub(replacement, dictionary[key], filedata)
-
-# replace in the original file if "inplace" is chosen
-if args.inplace_newFile == "inplace":
-    with open(args.target_file, 'w') as target_file:
-        target_file.write(filedata)
-
-# create a new file if "new" is chosen
+    MODE = "all_matches"
+
+# look for the compiled dictionary in the cache
+compiled_dictionary = None
+if not args.no_cache:
+    cache_filename = get_cache_filename(args.cache_dir, args.dictionary, MODE)
+    compiled_dictionary = load_from_cache(cache_filename)
+
+    if compiled_dictionary is not None:
+        print(f"Loaded compiled dictionary from {cache_filename}")
+
+# if not found, read in the dictionary file and compile it
+if compiled_dictionary is None:
+    dictionary = read_dictionary(args.dictionary)
+
+    if not dictionary:
+        print(f"*** ERROR ***\nNo keys found in {args.dictionary}.")
+        exit(1)
+
+    # compile all the keys into a single pattern, unless only fasta headers are to be replaced
+    if args.fasta_headers:
+        compiled_dictionary = {key.encode(): value.encode() for key, value in dictionary.items()}
+    else:
+        compiled_dictionary = (dictionary, compile_matcher(dictionary, EXACT_MATCHES))
+
+    # a cache that cannot be written is not a reason to stop the replacement
+    if not args.no_cache:
+        try:
+            save_to_cache(cache_filename, compiled_dictionary, args.cache_max_size * 1000000)
+        except OSError as err:
+            print(f"*** WARNING ***\nCould not save the compiled dictionary in the cache: {err}")
+
+if args.fasta_headers:
+    byte_dictionary = compiled_dictionary
+    print(f"Read {len(byte_dictionary)} keys from {args.dictionary}")
 else:
-    outfilename = f"{args.target_file}_replaced"
-    with open(outfilename, 'w') as outfile:
-        [outfile.write(filedata)]
+    dictionary, matcher_code = compiled_dictionary
+    matcher = load_matcher(matcher_code)
+    print(f"Read {len(dictionary)} keys from {args.dictionary}")
+
+# expand glob patterns into the list of target files
+target_files = []
+for target in args.target_file:
+    if glob.has_magic(target):
+        target_files.extend(sorted(glob.glob(target)))
+    else:
+        target_files.append(target)
+target_files = list(dict.fromkeys(target_files))
+
+if not target_files:
+    print("*** ERROR ***\nNo target files found.")
+    exit(1)
+
+# process the target files, in parallel if more than one
+THREADS = min(args.threads or len(os.sched_getaffinity(0)), len(target_files))
+
+print(f"Replacing strings in {len(target_files)} target file(s) using {THREADS} process(es)...")
+print()
+print("file\tsize_MB\ttime_s\tthroughput_MB/s")
+
+start_time = time.perf_counter()
+results = []
+failed_files = []
+
+if THREADS == 1:
+    result_iterator = map(try_process_target_file, target_files)
+    pool = None
+else:
+    # forked workers inherit the compiled dictionary, so it is never rebuilt or pickled
+    pool = multiprocessing.get_context("fork").Pool(THREADS)
+    result_iterator = pool.imap_unordered(try_process_target_file, target_files)
+
+try:
+    for target_filename, result, error in result_iterator:
+        if error is not None:
+            failed_files.append((target_filename, error))
+            continue
+
+        results.append(result)
+        target_filename, file_size, elapsed = result[:3]
+        print(f"{target_filename}\t{file_size / 1e6:.2f}\t{elapsed:.2f}\t{file_size / 1e6 / max(elapsed, 1e-9):.2f}")
+finally:
+    if pool is not None:
+        pool.terminate()
+
+total_time = time.perf_counter() - start_time
+total_size = sum(result[1] for result in results)
+print(f"TOTAL\t{total_size / 1e6:.2f}\t{total_time:.2f}\t{total_size / 1e6 / max(total_time, 1e-9):.2f}")
+
+# report the keys of the dictionary that were never used
+if args.fasta_headers:
+    print()
+    for target_filename, file_size, elapsed, n_used, unused_filename, n_unused in sorted(results):
+        print(f"{target_filename}: {n_used} headers were replaced.")
+
+        if n_unused:
+            print(f"    {n_unused} keys of the dictionary were never used. If you want to check them, see {unused_filename}.")
+
+# report the target files that could not be processed
+if failed_files:
+    print()
+    print("*** ERROR ***")
+    for target_filename, error in sorted(failed_files):
+        print(f"{target_filename} could not be processed: {error}")
+    exit(1)
@@ -0,0 +1,232 @@
+#!/bin/env python3
+
+# Given the raw counts statistics of many samples (AccNo.rawmapping.stats.tsv, i.e. samtools idxstats outputs produced
+# by https://github.com/filonico/misc_scripts/blob/main/map_reads_bowtie.py), this script merges them into a
+# transcripts x samples matrix of mapped reads.
+# REQUIRED SOFTWARES: numpy
+#
+# The matrix is stored in a binary, column-major format (each sample is a contiguous column of 32-bit counts), in a
+# directory structured as follow:
+#
+# ./
+# └── your_matrix_dir/
+#     ├── counts.bin          (counts, one column after the other)
+#     ├── transcripts.tsv     (rows: transcript names and lengths)
+#     └── samples.tsv         (columns: sample names, mapped and unmapped reads, source file)
+#
+# When the script is run again on the same matrix, only the columns of new samples are appended to counts.bin, while
+# samples already in the matrix are skipped. All the samples must have been mapped against the same reference (same
+# transcript names).
+#
+# With --export, the matrix is also written as a tsv table (transcripts on rows, samples on columns).
+#
+#
+# Written by:   Filippo Nicolini
+# Last updated: 18/10/2026
+
+
+import argparse, sys, os, glob, tempfile, shutil
+import numpy as np
+
+
+##########################################
+#     Define arguments of the script     #
+##########################################
+
+# Initialise the parser class
+parser = argparse.ArgumentParser(description = "Merge samtools idxstats outputs of many samples into a count matrix.")
+
+# Define some options/arguments/parameters
+parser.add_argument("-i", "--input",
+                    nargs = "+",
+                    default = [],
+                    help = "Raw counts statistics files (AccNo.rawmapping.stats.tsv), or directories containing them.")
+
+parser.add_argument("-m", "--matrix_dir",
+                    help = "Directory of the count matrix, created if missing. Default: rawcounts_matrix",
+                    default = "rawcounts_matrix")
+
+parser.add_argument("-e", "--export",
+                    help = "Write the count matrix as a tsv table to this file.",
+                    default = None)
+
+# This line checks if the user gave no arguments, and if so then print the help
+parser.parse_args(args = None if sys.argv[1:] else ["--help"])
+
+# Collect the inputted arguments into a dictionary
+args = parser.parse_args()
+
+
+STATS_SUFFIX = ".rawmapping.stats.tsv"
+COUNT_TYPE = np.uint32
+
+
+############################
+#     Define functions     #
+############################
+
+# Function to read a raw counts statistics file.
+# Returns transcript names and lengths, mapped reads of each transcript, and unmapped reads (the "*" line).
+def read_idxstats(stats_file):
+    names, lengths, counts = [], [], []
+    unmapped_reads = 0
+
+    with open(stats_file) as stats:
+        for line in stats:
+            name, length, mapped, unmapped = line.rstrip("\n").split("\t")
+            if name == "*":
+                unmapped_reads += int(unmapped)
+                continue
+
+            names.append(name)
+            lengths.append(int(length))
+            counts.append(int(mapped))
+
+    return names, lengths, np.array(counts, dtype = np.int64), unmapped_reads
+
+
+# Function to write a file atomically, given the list of its lines: a temporary file replaces the old one only once
+# it is complete, so that an interrupted run never leaves a partial file.
+# Temporary files are only readable by their owner, so they get the permissions of the old file (or the default ones
+# of a new file), so that the matrix can still be shared.
+def write_lines(filename, lines):
+    tmp_handle, tmp_filename = tempfile.mkstemp(prefix = ".tmp.", dir = os.path.dirname(os.path.abspath(filename)))
+    try:
+        with open(tmp_handle, "w") as tmp_file:
+            tmp_file.writelines(line + "\n" for line in lines)
+
+        if os.path.isfile(filename):
+            shutil.copymode(filename, tmp_filename)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_filename, 0o666 & ~umask)
+
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+# Function to read the rows and columns of the count matrix. Returns empty lists for a new matrix.
+def read_matrix_metadata(matrix_dir):
+    transcripts, samples = [], []
+
+    if os.path.isfile(f"{matrix_dir}/transcripts.tsv"):
+        with open(f"{matrix_dir}/transcripts.tsv") as transcripts_file:
+            transcripts = [line.rstrip("\n").split("\t") for line in transcripts_file]
+
+    if os.path.isfile(f"{matrix_dir}/samples.tsv"):
+        with open(f"{matrix_dir}/samples.tsv") as samples_file:
+            samples = [line.rstrip("\n").split("\t") for line in samples_file][1:]
+
+    return transcripts, samples
+
+
+# Function to open the count matrix as a (samples x transcripts) memory-mapped array, i.e. one row per sample column
+def open_counts(matrix_dir, n_transcripts, n_samples):
+    if not n_transcripts or not n_samples:
+        return np.zeros((n_samples, n_transcripts), dtype = COUNT_TYPE)
+
+    return np.memmap(f"{matrix_dir}/counts.bin", dtype = COUNT_TYPE, mode = "r", shape = (n_samples, n_transcripts))
+
+
+# Function to append the columns of new samples to the count matrix, given the list of raw counts statistics files
+def append_samples(matrix_dir, stats_files):
+    transcripts, samples = read_matrix_metadata(matrix_dir)
+    known_samples = {sample[0] for sample in samples}
+    counts_filename = f"{matrix_dir}/counts.bin"
+
+    # Columns written by an interrupted run, but not recorded in samples.tsv, are dropped
+    if os.path.isfile(counts_filename):
+        os.truncate(counts_filename, len(samples) * len(transcripts) * np.dtype(COUNT_TYPE).itemsize)
+
+    row_order = None
+    new_samples = []
+
+    with open(counts_filename, "ab") as counts_file:
+        for stats_file in stats_files:
+            sample = os.path.basename(stats_file)[:-len(STATS_SUFFIX)] if stats_file.endswith(STATS_SUFFIX) else os.path.basename(stats_file)
+            if sample in known_samples:
+                print(f"  {sample} is already in the matrix, skipping it")
+                continue
+
+            names, lengths, counts, unmapped_reads = read_idxstats(stats_file)
+
+            # The first sample of a new matrix defines its rows
+            if not transcripts:
+                transcripts = [[name, str(length)] for name, length in zip(names, lengths)]
+
+            # Rows are usually in the same order in all the samples (the order of the reference), otherwise reorder them
+            if names != [transcript[0] for transcript in transcripts]:
+                if row_order is None:
+                    row_order = {transcript[0]: row for row, transcript in enumerate(transcripts)}
+
+                if len(names) != len(transcripts) or any(name not in row_order for name in names):
+                    sys.exit(f"ERROR: transcripts in {stats_file} are not the same as in the matrix: was it mapped against a different reference?")
+
+                reordered_counts = np.zeros(len(transcripts), dtype = np.int64)
+                reordered_counts[[row_order[name] for name in names]] = counts
+                counts = reordered_counts
+
+            if counts.max(initial = 0) > np.iinfo(COUNT_TYPE).max:
+                sys.exit(f"ERROR: counts in {stats_file} do not fit in the matrix")
+
+            counts_file.write(counts.astype(COUNT_TYPE).tobytes())
+            samples.append([sample, str(int(counts.sum())), str(unmapped_reads), os.path.abspath(stats_file)])
+            known_samples.add(sample)
+            new_samples.append(sample)
+
+        counts_file.flush()
+        os.fsync(counts_file.fileno())
+
+    # Record the new columns only once they are on disk
+    write_lines(f"{matrix_dir}/transcripts.tsv", ["\t".join(transcript) for transcript in transcripts])
+    write_lines(f"{matrix_dir}/samples.tsv", ["sample\tmapped_reads\tunmapped_reads\tsource"] + ["\t".join(sample) for sample in samples])
+
+    return new_samples
+
+
+# Function to write the count matrix as a tsv table (transcripts on rows, samples on columns)
+def export_tsv(matrix_dir, output_filename):
+    transcripts, samples = read_matrix_metadata(matrix_dir)
+    counts = np.ascontiguousarray(open_counts(matrix_dir, len(transcripts), len(samples)).T)
+
+    with open(output_filename, "w") as output_file:
+        output_file.write("transcript\tlength\t" + "\t".join(sample[0] for sample in samples) + "\n")
+        for (name, length), row in zip(transcripts, counts):
+            output_file.write(f"{name}\t{length}\t" + "\t".join(map(str, row.tolist())) + "\n")
+
+
+#------------------------------------------------------------------------------------------
+
+
+###################################
+#     Update the count matrix     #
+###################################
+
+# Collect raw counts statistics files, looking into directories
+STATS_FILES = []
+for path in args.input:
+    if os.path.isdir(path):
+        STATS_FILES += sorted(glob.glob(f"{path}/*{STATS_SUFFIX}"))
+    else:
+        STATS_FILES.append(path)
+
+os.makedirs(args.matrix_dir, exist_ok = True)
+
+if STATS_FILES:
+    print()
+    print(f"Adding {len(STATS_FILES)} raw counts statistics files to {args.matrix_dir}/...")
+    NEW_SAMPLES = append_samples(args.matrix_dir, STATS_FILES)
+    print(f"  {len(NEW_SAMPLES)} new samples added")
+
+TRANSCRIPTS, SAMPLES = read_matrix_metadata(args.matrix_dir)
+print()
+print(f"Count matrix: {len(TRANSCRIPTS)} transcripts x {len(SAMPLES)} samples")
+
+if args.export:
+    print(f"Exporting the count matrix to {args.export}...")
+    export_tsv(args.matrix_dir, args.export)
+
+print()
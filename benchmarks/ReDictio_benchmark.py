@@ -0,0 +1,114 @@
+#!/bin/env python3
+
+# This script benchmarks ReDictio.py on synthetic data, showing how the run time scales with the number of dictionary keys.
+#
+# For each number of keys, it generates a fasta file and a dictionary renaming all of its headers, then it times:
+#   * ReDictio.py (single-pass replacement);
+#   * the legacy approach of running one re.sub per dictionary key over the whole file (only up to --legacy_max_keys keys).
+#
+# Results are printed as a tsv table.
+#
+#
+# Written by:   Filippo Nicolini
+# Last updated: 18/10/2026
+
+import subprocess, argparse, sys, os, re, random, tempfile, time
+
+
+##########################################
+#     Define arguments of the script     #
+##########################################
+
+# Initialise the parser class
+parser = argparse.ArgumentParser(description = "Benchmark ReDictio.py against the number of dictionary keys.")
+
+# Define some options/arguments/parameters
+parser.add_argument("-k", "--keys",
+                    help = "Comma separated list of dictionary sizes to test. Default: 100,1000,10000,100000",
+                    default = "100,1000,10000,100000")
+
+parser.add_argument("-l", "--legacy_max_keys",
+                    type = int,
+                    help = "Largest dictionary size the legacy per-key approach is run on. Default: 1000",
+                    default = 1000)
+
+parser.add_argument("-m", "--exact_matches",
+                    action = "store_true",
+                    help = "Benchmark exact word matches. Default: False",
+                    default = False)
+
+# Collect the inputted arguments into a dictionary
+args = parser.parse_args()
+
+
+REDICTIO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ReDictio.py")
+
+
+############################
+#     Define functions     #
+############################
+
+# Function to write a synthetic fasta file with n sequences and the dictionary renaming its headers
+def write_synthetic_data(n_keys, fasta_path, dictionary_path):
+    random.seed(n_keys)
+    with open(fasta_path, "w") as fasta, open(dictionary_path, "w") as dictionary:
+        for i in range(n_keys):
+            fasta.write(f">gene{i} some description\n")
+            fasta.write("".join(random.choices("ACGT", k = 120)) + "\n")
+            dictionary.write(f"gene{i}\tspecies_gene{i}\n")
+
+
+# Function to replace strings the way ReDictio did before the single-pass engine
+def legacy_replace(fasta_path, dictionary_path, exact_matches):
+    dictionary = {}
+    with open(dictionary_path) as dictionary_file:
+        for line in dictionary_file:
+            dictionary[line.split("\t")[0].strip()] = line.split("\t")[1].strip()
+
+    with open(fasta_path) as fasta:
+        filedata = fasta.read()
+
+    for key in dictionary:
+        if exact_matches:
+            filedata = re.sub(r"\b" + re.escape(key) + r"\b", dictionary[key], filedata)
+        else:
+            filedata = re.sub(re.escape(key), dictionary[key], filedata)
+
+    return filedata
+
+
+#------------------------------------------------------------------------------------------
+
+
+#############################
+#     Run the benchmark     #
+#############################
+
+print("keys\tfile_size_MB\tredictio_s\tlegacy_s")
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    for n_keys in [int(n) for n in args.keys.split(",")]:
+        fasta_path = f"{tmpdir}/synthetic_{n_keys}.fasta"
+        dictionary_path = f"{tmpdir}/synthetic_{n_keys}.tsv"
+        write_synthetic_data(n_keys, fasta_path, dictionary_path)
+
+        start = time.perf_counter()
+        subprocess.run([sys.executable, REDICTIO,
+                        "-f", fasta_path,
+                        "-d", dictionary_path,
+                        "-m", str(args.exact_matches),
+                        "-i", "new",
+                        "--no_cache"],
+                       check = True,
+                       capture_output = True)
+        redictio_time = time.perf_counter() - start
+
+        if n_keys <= args.legacy_max_keys:
+            start = time.perf_counter()
+            legacy_replace(fasta_path, dictionary_path, args.exact_matches)
+            legacy_time = f"{time.perf_counter() - start:.3f}"
+        else:
+            legacy_time = "NA"
+
+        file_size = os.path.getsize(fasta_path) / 1e6
+        print(f"{n_keys}\t{file_size:.2f}\t{redictio_time:.3f}\t{legacy_time}")
@@ -0,0 +1,113 @@
+#!/bin/env python3
+
+# This script benchmarks extract_sequences_from_fasta.py on synthetic fasta files of increasing size.
+#
+# For each fasta size, it extracts a random subset of the sequences and times:
+#   * the built-in bytes-level reader (extract_sequences_from_fasta.py --no_index);
+#   * the indexed extraction, both when the index has to be built and when it is reused;
+#   * the Biopython path the script used before (SeqIO.parse + SeqIO.write "fasta-2line"), if Biopython is installed.
+#
+# Every run is a separate python process, so that import costs are taken into account. Results are printed as a tsv table.
+#
+#
+# Written by:   Filippo Nicolini
+# Last updated: 18/10/2026
+
+import subprocess, argparse, sys, os, random, tempfile, time, importlib.util
+
+
+##########################################
+#     Define arguments of the script     #
+##########################################
+
+# Initialise the parser class
+parser = argparse.ArgumentParser(description = "Benchmark extract_sequences_from_fasta.py against the size of the fasta file.")
+
+# Define some options/arguments/parameters
+parser.add_argument("-n", "--n_sequences",
+                    help = "Comma separated list of fasta sizes (number of sequences) to test. Default: 1000,10000,100000,1000000",
+                    default = "1000,10000,100000,1000000")
+
+parser.add_argument("-s", "--subset",
+                    type = float,
+                    help = "Fraction of the sequences to extract. Default: 0.01",
+                    default = 0.01)
+
+# Collect the inputted arguments into a dictionary
+args = parser.parse_args()
+
+
+EXTRACT_SEQUENCES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "extract_sequences_from_fasta.py")
+
+# The extraction as it was done with Biopython
+SEQIO_EXTRACTION = """
+import sys
+from Bio import SeqIO
+
+header_set = set(line.strip() for line in open(sys.argv[1]))
+found = set()
+with open(sys.argv[3], "w") as output_file:
+    for sequence in SeqIO.parse(sys.argv[2], "fasta"):
+        if sequence.id in header_set and sequence.id not in found:
+            SeqIO.write(sequence, output_file, "fasta-2line")
+            found.add(sequence.id)
+"""
+
+
+############################
+#     Define functions     #
+############################
+
+# Function to write a synthetic fasta file with n sequences (60 bases per line) and a list with a subset of its headers
+def write_synthetic_data(n_sequences, fasta_path, list_path):
+    random.seed(n_sequences)
+    with open(fasta_path, "w") as fasta:
+        for i in range(n_sequences):
+            sequence = "".join(random.choices("ACGT", k = random.randint(100, 1000)))
+            fasta.write(f">seq{i} synthetic sequence {i}\n")
+            fasta.write("\n".join(sequence[j:j + 60] for j in range(0, len(sequence), 60)) + "\n")
+
+    with open(list_path, "w") as header_list:
+        for i in random.sample(range(n_sequences), max(1, int(n_sequences * args.subset))):
+            header_list.write(f"seq{i}\n")
+
+
+# Function to time a command
+def time_command(command):
+    start = time.perf_counter()
+    subprocess.run(command, check = True, capture_output = True)
+
+    return time.perf_counter() - start
+
+
+#------------------------------------------------------------------------------------------
+
+
+#############################
+#     Run the benchmark     #
+#############################
+
+HAS_BIOPYTHON = importlib.util.find_spec("Bio") is not None
+
+print("sequences\tfile_size_MB\tbytes_reader_s\tindex_build_s\tindex_reuse_s\tseqio_s")
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    for n_sequences in [int(n) for n in args.n_sequences.split(",")]:
+        fasta_path = f"{tmpdir}/synthetic_{n_sequences}.fasta"
+        list_path = f"{tmpdir}/synthetic_{n_sequences}.ls"
+        output_path = f"{tmpdir}/extracted_{n_sequences}.fasta"
+        write_synthetic_data(n_sequences, fasta_path, list_path)
+
+        extract_command = [sys.executable, EXTRACT_SEQUENCES, "-l", list_path, "-f", fasta_path, "-o", output_path]
+
+        bytes_reader_time = time_command(extract_command + ["--no_index"])
+        index_build_time = time_command(extract_command)
+        index_reuse_time = time_command(extract_command)
+
+        if HAS_BIOPYTHON:
+            seqio_time = f"{time_command([sys.executable, '-c', SEQIO_EXTRACTION, list_path, fasta_path, output_path]):.3f}"
+        else:
+            seqio_time = "NA"
+
+        file_size = os.path.getsize(fasta_path) / 1e6
+        print(f"{n_sequences}\t{file_size:.2f}\t{bytes_reader_time:.3f}\t{index_build_time:.3f}\t{index_reuse_time:.3f}\t{seqio_time}")
@@ -0,0 +1,120 @@
+#!/bin/env python3
+
+# This script benchmarks the trimming engines of trim_reads.py on synthetic paired fastq files of increasing size.
+#
+# For each number of read pairs, it writes a synthetic sample (reads with quality dropping towards their 3' end) and
+# times trim_reads.py with:
+#   * the native NumPy engine (--engine native);
+#   * trimmomatic (--engine trimmomatic), if it is installed.
+#
+# Both runs use a single core and skip fastqc, and the number of read pairs kept in the paired files is reported as a
+# sanity check (they can differ slightly, since the native engine does not clip adapters). Results are printed as a tsv
+# table.
+#
+#
+# Written by:   Filippo Nicolini
+# Last updated: 18/10/2026
+
+import subprocess, argparse, sys, os, tempfile, time, gzip, shutil
+import numpy as np
+
+
+##########################################
+#     Define arguments of the script     #
+##########################################
+
+# Initialise the parser class
+parser = argparse.ArgumentParser(description = "Benchmark trim_reads.py engines against the number of reads.")
+
+# Define some options/arguments/parameters
+parser.add_argument("-n", "--n_pairs",
+                    help = "Comma separated list of sample sizes (number of read pairs) to test. Default: 10000,100000,1000000",
+                    default = "10000,100000,1000000")
+
+parser.add_argument("-l", "--read_length",
+                    type = int,
+                    help = "Length of the synthetic reads. Default: 150",
+                    default = 150)
+
+# Collect the inputted arguments into a dictionary
+args = parser.parse_args()
+
+
+TRIM_READS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "trim_reads.py")
+
+# TruSeq adapters, needed by the trimmomatic ILLUMINACLIP step
+ADAPTERS = """>PrefixPE/1
+TACACTCTTTCCCTACACGACGCTCTTCCGATCT
+>PrefixPE/2
+GTGACTGGAGTTCAGACGTGTGCTCTTCCGATCT
+"""
+
+
+############################
+#     Define functions     #
+############################
+
+# Function to write a synthetic paired sample, whose qualities decrease along the reads
+def write_synthetic_sample(n_pairs, sample_dir):
+    random_generator = np.random.default_rng(n_pairs)
+    acc = os.path.basename(sample_dir)
+    os.makedirs(sample_dir)
+
+    for mate in (1, 2):
+        sequences = random_generator.choice(np.frombuffer(b"ACGT", dtype = np.uint8), size = (n_pairs, args.read_length))
+        decay = random_generator.uniform(0.05, 0.4, size = (n_pairs, 1))
+        qualities = random_generator.normal(38 - decay * np.arange(args.read_length), 4)
+        qualities = (np.clip(qualities, 2, 41) + 33).astype(np.uint8)
+
+        with gzip.open(f"{sample_dir}/{acc}_{mate}.fastq.gz", "wb", compresslevel = 1) as fastq:
+            fastq.write(b"".join(b"@read%d/%d\n" % (i, mate) + sequences[i].tobytes() + b"\n+\n" + qualities[i].tobytes() + b"\n"
+                                 for i in range(n_pairs)))
+
+
+# Function to time trim_reads.py on a sample, given the engine.
+# Returns the run time and the number of pairs kept in the paired files.
+def time_engine(engine, sample_dir, output_dir, adapters_path):
+    command = [sys.executable, TRIM_READS, "-d", sample_dir, "-o", output_dir, "-e", engine, "-c", "1", "--skip_fastqc"]
+    if engine == "trimmomatic":
+        command += ["-a", adapters_path]
+
+    start = time.perf_counter()
+    subprocess.run(command, check = True, capture_output = True)
+    run_time = time.perf_counter() - start
+
+    acc = os.path.basename(sample_dir)
+    with gzip.open(f"{output_dir}/{acc}_trimmed/{acc}_1_paired.fastq.gz", "rb") as paired:
+        kept_pairs = sum(1 for line in paired) // 4
+
+    return run_time, kept_pairs
+
+
+#------------------------------------------------------------------------------------------
+
+
+#############################
+#     Run the benchmark     #
+#############################
+
+HAS_TRIMMOMATIC = shutil.which("trimmomatic") is not None
+
+print("read_pairs\tnative_s\tnative_kept_pairs\ttrimmomatic_s\ttrimmomatic_kept_pairs")
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    adapters_path = f"{tmpdir}/adapters.fa"
+    with open(adapters_path, "w") as adapters:
+        adapters.write(ADAPTERS)
+
+    for n_pairs in [int(n) for n in args.n_pairs.split(",")]:
+        sample_dir = f"{tmpdir}/SAMPLE{n_pairs}"
+        write_synthetic_sample(n_pairs, sample_dir)
+
+        native_time, native_kept = time_engine("native", sample_dir, f"{tmpdir}/native_{n_pairs}", adapters_path)
+
+        if HAS_TRIMMOMATIC:
+            trimmomatic_time, trimmomatic_kept = time_engine("trimmomatic", sample_dir, f"{tmpdir}/trimmomatic_{n_pairs}", adapters_path)
+            trimmomatic_time = f"{trimmomatic_time:.3f}"
+        else:
+            trimmomatic_time, trimmomatic_kept = "NA", "NA"
+
+        print(f"{n_pairs}\t{native_time:.3f}\t{native_kept}\t{trimmomatic_time}\t{trimmomatic_kept}")
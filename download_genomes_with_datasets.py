@@ -20,11 +20,38 @@
 #     ...
 #     └── GCX.XXXXXXXXN.X[_spIDN].zip
 #
+# Assemblies are downloaded in parallel by a pool of workers (--threads). Failed downloads are retried with an
+# exponential backoff, and accessions that could not be downloaded at all are listed in your_output_dir/failed_accessions.ls:
+# in this case the script exits with a non-zero status.
+#
+# With --batch, all the assemblies are downloaded at once as a single dehydrated package (i.e., with only the metadata
+# and the links to the data files), which is then rehydrated by parallel workers (--threads, up to 30) and split into the
+# same per-assembly archives described above. This avoids running one datasets process per assembly.
+#
+# With --extract, the requested members of each archive (e.g., protein.faa,genomic.gff) are streamed straight out of the
+# archives, optionally gzipped (--extract_compression), without unpacking them. Members of the same kind are collected
+# in the same directory:
+#
+# └── your_output_dir/
+#     └── extracted/
+#         ├── protein.faa/
+#         |   ├── GCX.XXXXXXXX1.X[_spID1]_protein.faa[.gz]
+#         |   ...
+#         └── genomic.gff/
+#             ├── GCX.XXXXXXXX1.X[_spID1]_genomic.gff[.gz]
+#             ...
+#
+# Each downloaded archive is checked (CRC test of all its members) and recorded, with its size and sha256 checksum, in
+# your_output_dir/download_manifest.tsv. When the script is run again, assemblies whose archive is already recorded in the
+# manifest are skipped, so an interrupted run can be resumed by just re-running the same command: only missing or
+# corrupted archives are downloaded again.
+#
 # Written by:   Filippo Nicolini
-# Last updated: 05/02/2025
+# Last updated: 18/10/2026
 
 
-import subprocess, argparse, sys, os
+import subprocess, argparse, sys, os, time, threading, hashlib, zipfile, json, shutil, fnmatch, gzip
+from concurrent.futures import ThreadPoolExecutor
 
 
 ##########################################
@@ -55,6 +82,40 @@ parser.add_argument("-o", "--output_dir",
                     help = "Name of the output directory. Default \"00_datasets\"",
                     default = "00_datasets")
 
+parser.add_argument("-t", "--threads",
+                    type = int,
+                    help = "Number of assemblies to download at the same time. Default: 4",
+                    default = 4)
+
+parser.add_argument("-r", "--retries",
+                    type = int,
+                    help = "Number of times a failed download is retried. Default: 3",
+                    default = 3)
+
+parser.add_argument("-b", "--backoff",
+                    type = float,
+                    help = "Seconds to wait before the first retry of a failed download; the waiting time doubles at each retry. Default: 10",
+                    default = 10)
+
+parser.add_argument("--batch",
+                    action = "store_true",
+                    help = "Download all the assemblies as a single dehydrated package, rehydrate it with --threads parallel workers, and split it into per-assembly archives. Default: False",
+                    default = False)
+
+parser.add_argument("-x", "--extract",
+                    help = "Members of the archives to be extracted into your_output_dir/extracted/, as a comma separated string of file names within each assembly (wildcards are allowed, e.g.: protein.faa,genomic.gff,GC*_genomic.fna). Default: do not extract")
+
+parser.add_argument("-c", "--extract_compression",
+                    type = int,
+                    choices = range(10),
+                    help = "Gzip compression level of extracted members (0 means not compressed). Default: 0",
+                    default = 0)
+
+parser.add_argument("-v", "--verify",
+                    action = "store_true",
+                    help = "Verify the checksum and the integrity of archives already recorded in the manifest, instead of only checking their size. Default: False",
+                    default = False)
+
 # This line checks if the user gave no arguments, and if so then print the help
 parser.parse_args(args = None if sys.argv[1:] else ["--help"])
 
@@ -66,17 +127,326 @@ args = parser.parse_args()
 #     Define functions     #
 ############################
 
-# Function to retrieve genome assembly feature
+# Make sure messages from different workers are not mixed up, and that they do not write the manifest at the same time
+print_lock = threading.Lock()
+manifest_lock = threading.Lock()
+
 
-def download_assembly_feature(accession,exe_path,features,output):
+# Function to check the integrity of a zip archive, testing the CRC of all its members
+
+def check_archive(archive):
     try:
-        datasets_process = subprocess.run(f"{exe_path} download genome accession {accession} --filename {output} --include {features}",
-        shell = True,
-        capture_output = True,
-        text = True)
+        with zipfile.ZipFile(archive) as zip_archive:
+            return zip_archive.testzip() is None
+
+    except (zipfile.BadZipFile, OSError, EOFError):
+        return False
+
+
+# Function to compute the sha256 checksum of a file
+
+def get_checksum(filename):
+    checksum = hashlib.sha256()
+    with open(filename, 'rb') as input_file:
+        for block in iter(lambda: input_file.read(1 << 20), b""):
+            checksum.update(block)
+
+    return checksum.hexdigest()
+
+
+# Function to read the manifest of downloaded archives into a dictionary: {archive name: (size, checksum)}
+
+def read_manifest(manifest):
+    manifest_entries = {}
+
+    if os.path.isfile(manifest):
+        with open(manifest) as input_manifest:
+            for line in input_manifest:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) == 4 and fields[0] != "accession":
+                    manifest_entries[fields[1]] = (int(fields[2]), fields[3])
+
+    return manifest_entries
+
+
+# Function to record a downloaded archive in the manifest
+
+def add_to_manifest(accession, archive):
+    size, checksum = os.path.getsize(archive), get_checksum(archive)
+
+    with manifest_lock:
+        write_header = not os.path.isfile(MANIFEST)
+        with open(MANIFEST, 'a') as output_manifest:
+            if write_header:
+                output_manifest.write("accession\tarchive\tsize\tsha256\n")
+            output_manifest.write(f"{accession}\t{os.path.basename(archive)}\t{size}\t{checksum}\n")
+
+        manifest_entries[os.path.basename(archive)] = (size, checksum)
+
+
+# Function to tell whether the archive of an assembly has already been downloaded and is valid.
+# Archives recorded in the manifest are trusted if their size did not change (or, with --verify, if their checksum
+# matches and they pass the integrity check); archives not recorded are checked and, if valid, added to the manifest.
+
+def is_already_downloaded(accession, archive):
+    if not os.path.isfile(archive):
+        return False
+
+    manifest_entry = manifest_entries.get(os.path.basename(archive))
+
+    if manifest_entry:
+        size, checksum = manifest_entry
+        if os.path.getsize(archive) == size:
+            if not args.verify or (get_checksum(archive) == checksum and check_archive(archive)):
+                return True
+
+    elif check_archive(archive):
+        add_to_manifest(accession, archive)
+        return True
+
+    return False
+
+
+# Function to retrieve genome assembly feature.
+# The archive is downloaded to a temporary file, which is renamed only if datasets succeeded.
+# Returns the error message of datasets, or None if the download succeeded.
+
+def download_assembly_feature(accession,exe_path,features,output,extra_options = ""):
+    tmp_output = output[:-len(".zip")] + ".part.zip"
+
+    datasets_process = subprocess.run(f"{exe_path} download genome accession {accession} --filename {tmp_output} --include {features} {extra_options}",
+    shell = True,
+    capture_output = True,
+    text = True)
+
+    try:
+        datasets_process.check_returncode()
 
     except subprocess.CalledProcessError as err:
-        print("An error occured:", err.stderr)
+        if os.path.isfile(tmp_output):
+            os.remove(tmp_output)
+        return err.stderr.strip() or f"datasets exited with status {err.returncode}"
+
+    if not check_archive(tmp_output):
+        if os.path.isfile(tmp_output):
+            os.remove(tmp_output)
+        return "the downloaded archive is corrupted"
+
+    os.replace(tmp_output, output)
+
+
+# Function to run a download step (a function returning an error message, or None if it succeeded), retrying it
+# with an exponential backoff if it fails.
+# Returns the error message of the last attempt, or None if the step succeeded.
+
+def run_with_retries(name,download_step,*step_args):
+    for attempt in range(args.retries + 1):
+        if attempt:
+            time.sleep(args.backoff * 2 ** (attempt - 1))
+
+        error = download_step(*step_args)
+        if error is None:
+            return None
+
+        with print_lock:
+            print(f"  {name}: attempt {attempt + 1}/{args.retries + 1} failed: {error.splitlines()[-1]}")
+
+    return error
+
+
+# Function to rehydrate a dehydrated package, i.e. to download its data files with parallel workers.
+# Returns the error message of datasets, or None if the rehydration succeeded.
+
+def rehydrate_package(exe_path,package_dir,workers):
+    rehydrate_process = subprocess.run(f"{exe_path} rehydrate --directory {package_dir} --max-workers {workers}",
+                                       shell = True,
+                                       capture_output = True,
+                                       text = True)
+
+    try:
+        rehydrate_process.check_returncode()
+
+    except subprocess.CalledProcessError as err:
+        return err.stderr.strip() or f"datasets exited with status {err.returncode}"
+
+
+# Function to create the archive of a single assembly out of a rehydrated package, with the same content that
+# "datasets download genome accession" would have produced for that assembly alone.
+# Returns the accession number and the error message, if any.
+
+def split_package(assembly,package_dir,data_reports,catalog):
+    output_name = get_output_name(assembly)
+    tmp_output = output_name[:-len(".zip")] + ".part.zip"
+    data_dir = package_dir + "/ncbi_dataset/data"
+
+    # Look for the directory of the assembly (the accession number may have been given without its version)
+    assembly_dirs = [directory for directory in os.listdir(data_dir)
+                     if os.path.isdir(f"{data_dir}/{directory}") and (directory == assembly[0] or directory.startswith(assembly[0] + "."))]
+    if not assembly_dirs:
+        return assembly[0], "the assembly is missing from the batch package"
+    assembly_dir = assembly_dirs[0]
+
+    with zipfile.ZipFile(tmp_output, 'w', compression = zipfile.ZIP_DEFLATED) as output_zip:
+        if os.path.isfile(package_dir + "/README.md"):
+            output_zip.write(package_dir + "/README.md", "README.md")
+
+        # Only keep the metadata of this assembly
+        output_zip.writestr("ncbi_dataset/data/assembly_data_report.jsonl",
+                            "".join(line for accession, line in data_reports if accession == assembly_dir))
+
+        assembly_catalog = dict(catalog)
+        assembly_catalog["assemblies"] = [entry for entry in catalog.get("assemblies", [])
+                                          if entry.get("accession") in (None, assembly_dir)]
+        output_zip.writestr("ncbi_dataset/data/dataset_catalog.json", json.dumps(assembly_catalog, indent = 2))
+
+        for root, dirs, files in os.walk(f"{data_dir}/{assembly_dir}"):
+            for file in sorted(files):
+                output_zip.write(f"{root}/{file}", os.path.relpath(f"{root}/{file}", package_dir))
+
+    if not check_archive(tmp_output):
+        os.remove(tmp_output)
+        return assembly[0], "the archive created from the batch package is corrupted"
+
+    os.replace(tmp_output, output_name)
+    add_to_manifest(assembly[0], output_name)
+
+    return assembly[0], None
+
+
+# Function to download all the assemblies as a single dehydrated package, rehydrate it and split it into
+# per-assembly archives.
+# Returns a list of accession numbers and error messages, if any.
+
+def download_batch(assemblies):
+    accession_file = args.output_dir + "/batch_accessions.ls"
+    package_zip = args.output_dir + "/batch_package.zip"
+    package_dir = args.output_dir + "/batch_package"
+
+    with open(accession_file, 'w') as output_accessions:
+        [output_accessions.write(f"{assembly[0]}\n") for assembly in assemblies]
+
+    try:
+        print("  Retrieving the dehydrated package...")
+        error = run_with_retries("batch package", download_assembly_feature,
+                                 f"--inputfile {accession_file}", DATASETS, args.features, package_zip, "--dehydrated")
+        if error is not None:
+            return [(assembly[0], error) for assembly in assemblies]
+
+        if os.path.isdir(package_dir):
+            shutil.rmtree(package_dir)
+        with zipfile.ZipFile(package_zip) as input_zip:
+            input_zip.extractall(package_dir)
+
+        print(f"  Rehydrating the package with {min(args.threads, 30)} parallel workers...")
+        error = run_with_retries("batch package", rehydrate_package, DATASETS, package_dir, min(args.threads, 30))
+        if error is not None:
+            return [(assembly[0], error) for assembly in assemblies]
+
+        # Read in the metadata of all the assemblies
+        data_reports = []
+        with open(package_dir + "/ncbi_dataset/data/assembly_data_report.jsonl") as input_reports:
+            for line in input_reports:
+                if line.strip():
+                    data_reports.append((json.loads(line).get("accession"), line))
+
+        with open(package_dir + "/ncbi_dataset/data/dataset_catalog.json") as input_catalog:
+            catalog = json.load(input_catalog)
+
+        print("  Splitting the package into per-assembly archives...")
+        with ThreadPoolExecutor(max_workers = args.threads) as executor:
+            return list(executor.map(lambda assembly: split_package(assembly, package_dir, data_reports, catalog), assemblies))
+
+    finally:
+        for file in accession_file, package_zip:
+            if os.path.isfile(file):
+                os.remove(file)
+        if os.path.isdir(package_dir):
+            shutil.rmtree(package_dir)
+
+
+# Function to stream the requested members of an archive into per-feature files, without unpacking the archive.
+# Members of the same assembly matching the same pattern are concatenated.
+# Returns the accession number and the error message, if any.
+
+def extract_features(assembly,patterns):
+    archive = get_output_name(assembly)
+    archive_name = os.path.basename(archive)[:-len(".zip")]
+    suffix = ".gz" if args.extract_compression else ""
+
+    try:
+        with zipfile.ZipFile(archive) as input_zip:
+            members = [member for member in input_zip.namelist()
+                       if member.startswith("ncbi_dataset/data/") and member.count("/") == 3]
+
+            for pattern in patterns:
+                feature = pattern.replace("*", "").strip("_.")
+                feature_dir = f"{args.output_dir}/extracted/{feature}"
+                output_name = f"{feature_dir}/{archive_name}_{feature}{suffix}"
+
+                matching_members = sorted(member for member in members if fnmatch.fnmatch(os.path.basename(member), pattern))
+                if not matching_members:
+                    continue
+
+                # Skip features already extracted from this very archive
+                if os.path.isfile(output_name) and os.path.getmtime(output_name) >= os.path.getmtime(archive):
+                    continue
+
+                os.makedirs(feature_dir, exist_ok = True)
+                tmp_output = output_name + ".part"
+
+                if args.extract_compression:
+                    output_file = gzip.open(tmp_output, 'wb', compresslevel = args.extract_compression)
+                else:
+                    output_file = open(tmp_output, 'wb')
+
+                with output_file:
+                    for member in matching_members:
+                        with input_zip.open(member) as input_member:
+                            shutil.copyfileobj(input_member, output_file, 1 << 20)
+
+                os.replace(tmp_output, output_name)
+
+    except (zipfile.BadZipFile, OSError) as err:
+        return assembly[0], str(err)
+
+    return assembly[0], None
+
+
+# Function to get the name of the output archive of an assembly, i.e. GCX.XXXXXXXXX.X[_spID].zip
+
+def get_output_name(assembly):
+    if len(assembly) == 1:
+        return args.output_dir + "/" + assembly[0].replace("_", ".") + ".zip"
+    else:
+        return args.output_dir + "/" + assembly[0].replace("_", ".") + "_" + assembly[1] + ".zip"
+
+
+# Function to download a single assembly (executed by the workers).
+# Returns the accession number and the error message, if any.
+
+def download_assembly(assembly):
+    output_name = get_output_name(assembly)
+
+    if is_already_downloaded(assembly[0], output_name):
+        with print_lock:
+            print(f"-- {assembly[0]} -- Already downloaded, skipping")
+        return assembly[0], None
+
+    with print_lock:
+        print(f"-- {assembly[0]} -- Retrieving selected features...")
+
+    error = run_with_retries(assembly[0], download_assembly_feature, assembly[0], DATASETS, args.features, output_name)
+
+    if error is None:
+        add_to_manifest(assembly[0], output_name)
+
+    with print_lock:
+        if error is None:
+            print(f"-- {assembly[0]} -- Done")
+        else:
+            print(f"-- {assembly[0]} -- FAILED")
+
+    return assembly[0], error
 
 
 #------------------------------------------------------------------------------------------
@@ -116,18 +486,75 @@ if args.species_ID and len(acc_list[0]) == 1:
 #     Download genome assembly features     #
 #############################################
 
-for assembly in acc_list:
-    if len(assembly) == 1:
-        output_name = args.output_dir + "/" + assembly[0].replace("_", ".") + ".zip"
-    else:
-        output_name = args.output_dir + "/" + assembly[0].replace("_", ".") + "_" + assembly[1] + ".zip"
+if args.datasets_path:
+    DATASETS = args.datasets_path
+else:
+    DATASETS = "datasets"
 
-    print(f"-- {assembly[0]} --")
-    print("  Retrieving selected features...")
+# Read in the manifest of the archives downloaded by previous runs
+MANIFEST = args.output_dir + "/download_manifest.tsv"
+manifest_entries = read_manifest(MANIFEST)
 
-    if args.datasets_path:
-        download_assembly_feature(assembly[0], args.datasets_path, args.features, output_name)
-    else:
-        download_assembly_feature(assembly[0], "datasets", args.features, output_name)
-    print("Done")
+if manifest_entries:
+    print(f"{len(manifest_entries)} archives were already downloaded according to {MANIFEST}.")
+
+if args.batch:
+    download_results = []
+    assemblies_to_download = []
+
+    for assembly in acc_list:
+        if is_already_downloaded(assembly[0], get_output_name(assembly)):
+            print(f"-- {assembly[0]} -- Already downloaded, skipping")
+            download_results.append((assembly[0], None))
+        else:
+            assemblies_to_download.append(assembly)
+
+    if assemblies_to_download:
+        print(f"Downloading {len(assemblies_to_download)} assemblies as a single batch...")
+        download_results += download_batch(assemblies_to_download)
+
+else:
+    print(f"Downloading with {args.threads} parallel workers...")
     print()
+
+    with ThreadPoolExecutor(max_workers = args.threads) as executor:
+        download_results = list(executor.map(download_assembly, acc_list))
+
+failed_downloads = [(accession, error) for accession, error in download_results if error is not None]
+
+print()
+print(f"{len(acc_list) - len(failed_downloads)} out of {len(acc_list)} assemblies were successfully downloaded.")
+
+
+#########################################################
+#     Extract the requested members of the archives     #
+#########################################################
+
+if args.extract:
+    patterns = [pattern.strip() for pattern in args.extract.split(",") if pattern.strip()]
+    download_errors = dict(download_results)
+    downloaded_assemblies = [assembly for assembly in acc_list if download_errors.get(assembly[0]) is None]
+
+    print()
+    print(f"Extracting {', '.join(patterns)} from {len(downloaded_assemblies)} archives into {args.output_dir}/extracted/...")
+
+    with ThreadPoolExecutor(max_workers = args.threads) as executor:
+        extraction_results = list(executor.map(lambda assembly: extract_features(assembly, patterns), downloaded_assemblies))
+
+    for accession, error in extraction_results:
+        if error is not None:
+            print(f"  {accession}: extraction failed: {error}")
+            failed_downloads.append((accession, f"extraction failed: {error}"))
+
+
+# Report failed downloads and exit with an error
+failed_filename = args.output_dir + "/failed_accessions.ls"
+if os.path.isfile(failed_filename):
+    os.remove(failed_filename)
+
+if failed_downloads:
+    with open(failed_filename, 'w') as failed_file:
+        [failed_file.write(f"{accession}\t{error.splitlines()[-1]}\n") for accession, error in failed_downloads]
+
+    print(f"{len(failed_downloads)} assemblies could not be downloaded or extracted. If you want to check them, see {failed_filename}.")
+    sys.exit(1)
@@ -21,12 +21,27 @@
 #         ├── SRRXXXXXXN_1.fastq.gz
 #         └── SRRXXXXXXN_2.fastq.gz
 #
+# Accessions are processed through a pipeline of four stages: prefetch -> fastq-dump -> fastqc -> gzip. Each stage has
+# its own pool of workers, so that, e.g., the next accession is prefetched while the previous one is being dumped and
+# compressed. The number of workers of each stage can be set with --prefetch_jobs, --dump_jobs, --qc_jobs and
+# --compress_jobs. At the end, the time each stage spent working is reported.
+#
+# With --direct_compression, fastq files are never written uncompressed: reads are dumped by the multi-threaded
+# fasterq-dump and streamed straight into parallel compressors (pigz, if available), with the same SRR_1/_2.fastq.gz
+# layout. In this case, the gzip stage is skipped and fastqc is run on the compressed files.
+# REQUIRED SOFTWARES for --direct_compression: sra-toolkit (with fasterq-dump), pigz (optional, otherwise gzip is used)
+#
+# To avoid filling the scratch filesystem, an accession is dumped only once its projected disk usage (size of the .sra
+# file times --expansion_factor) fits both in the free space and in the disk budget (--disk_budget, default: the free
+# space when the script starts) left by the accessions being processed. Otherwise, it waits until enough space is
+# released, i.e. until other accessions are done. An accession is always admitted when no other one is in progress.
+#
 #
 # Written by:   Filippo Nicolini
-# Last updated: 18/10/2023
+# Last updated: 18/10/2026
 
 
-import subprocess, argparse, sys, os
+import subprocess, argparse, sys, os, time, queue, threading, shutil, glob
 
 
 ##########################################
@@ -45,6 +60,57 @@ parser.add_argument("-o", "--output_dir",
                     help = "Name of the output directory.",
                     default = "01_raw_reads")
 
+parser.add_argument("--direct_compression",
+                    action = "store_true",
+                    help = "Dump reads with the multi-threaded fasterq-dump and compress them on the fly, without writing uncompressed fastq files. Default: False",
+                    default = False)
+
+parser.add_argument("--dump_threads",
+                    type = int,
+                    help = "Number of threads of each fasterq-dump process, with --direct_compression. Default: 6",
+                    default = 6)
+
+parser.add_argument("--compress_threads",
+                    type = int,
+                    help = "Number of threads of each pigz process (one per read file), with --direct_compression. Default: 4",
+                    default = 4)
+
+parser.add_argument("--compression_level",
+                    type = int,
+                    choices = range(1, 10),
+                    help = "Gzip compression level of fastq files. Default: 9",
+                    default = 9)
+
+parser.add_argument("--disk_budget",
+                    type = float,
+                    help = "Disk space (in GB) that accessions being processed can take up at the same time. Default: free space of the output directory",
+                    default = None)
+
+parser.add_argument("--expansion_factor",
+                    type = float,
+                    help = "Peak disk usage of an accession as a multiple of the size of its .sra file. Default: 7 (3 with --direct_compression)",
+                    default = None)
+
+parser.add_argument("--prefetch_jobs",
+                    type = int,
+                    help = "Number of accessions to prefetch at the same time. Default: 2",
+                    default = 2)
+
+parser.add_argument("--dump_jobs",
+                    type = int,
+                    help = "Number of accessions to convert to fastq at the same time. Default: 2",
+                    default = 2)
+
+parser.add_argument("--qc_jobs",
+                    type = int,
+                    help = "Number of accessions to check with fastqc at the same time. Default: 2",
+                    default = 2)
+
+parser.add_argument("--compress_jobs",
+                    type = int,
+                    help = "Number of accessions to gzip at the same time. Default: 4",
+                    default = 4)
+
 # This line checks if the user gave no arguments, and if so then print the help
 parser.parse_args(args = None if sys.argv[1:] else ["--help"])
 
@@ -54,6 +120,9 @@ args = parser.parse_args()
 
 output_dir = args.output_dir
 
+if args.expansion_factor is None:
+    args.expansion_factor = 3 if args.direct_compression else 7
+
 
 ############################
 #     Define functions     #
@@ -68,13 +137,15 @@ def download_sra(sra):
                                           capture_output = True,
                                           text = True)
         prefetch_process.check_returncode()
+        return True
         
     except subprocess.CalledProcessError as err:
         print("An error occured:", err.stderr)
+        return False
 
 
 # Function to download the fastq file, given the SRA file
-def download_fastq(sra_file):
+def download_fastq(sra_file, fastq_output_dir):
     try:
         # Download fastqs
         fastqdump_process = subprocess.run(f"fastq-dump --defline-seq '@$sn[_$rn]/$ri' --split-files {sra_file} -O {fastq_output_dir}",
@@ -82,11 +153,43 @@ def download_fastq(sra_file):
                                            capture_output = True,
                                            text = True)
         fastqdump_process.check_returncode()
+        return True
     
     except subprocess.CalledProcessError as err:
         print("An error occured:", err.stderr)
+        return False
         
 
+# Function to download compressed fastq files, given the SRA file.
+# Reads are dumped to the standard output one spot after the other by fasterq-dump, and awk sends each of them to the
+# compressor of the corresponding read file (according to the read number at the end of the header).
+# The exit status of the compressors is not seen by pipefail, so awk closes each of them and fails if any of them did.
+def download_compressed_fastq(sra_file, fastq_output_dir, acc):
+    if shutil.which("pigz"):
+        compressor = f"pigz -p {args.compress_threads} -{args.compression_level}"
+    else:
+        compressor = f"gzip -{args.compression_level}"
+
+    try:
+        fasterqdump_process = subprocess.run("set -o pipefail; "
+                                             f"fasterq-dump --split-spot --stdout --threads {args.dump_threads} "
+                                             f"--seq-defline '@$sn[_$rn]/$ri' --qual-defline '+' {sra_file} | "
+                                             f"awk -v compressor='{compressor}' -v prefix='{fastq_output_dir}/{acc}' "
+                                             "'NR % 4 == 1 { read = $0; sub(/.*\\//, \"\", read); output = compressor \" > \" prefix \"_\" read \".fastq.gz\"; outputs[output] } "
+                                             "{ print | output } "
+                                             "END { for (output in outputs) if (close(output) != 0) status = 1; exit status }'",
+                                             shell = True,
+                                             executable = "/bin/bash",
+                                             capture_output = True,
+                                             text = True)
+        fasterqdump_process.check_returncode()
+        return True
+
+    except subprocess.CalledProcessError as err:
+        print("An error occured:", err.stderr)
+        return False
+
+
 # Function to perform the quality check, given the fastq file
 def quality_check(fastq_file):
     try:
@@ -95,9 +198,176 @@ def quality_check(fastq_file):
                                         capture_output = True,
                                         text = True)
         fastqc_process.check_returncode()
+        return True
+
+    except subprocess.CalledProcessError as err:
+        print("An error occured:", err.stderr)
+        return False
+
+
+# Function to gzip fastq files, given the directory containing them
+def compress_fastq(fastq_output_dir):
+    try:
+        gzip_process = subprocess.run(f"gzip -{args.compression_level} {fastq_output_dir}/*fastq",
+                                      shell = True,
+                                      capture_output = True,
+                                      text = True)
+        gzip_process.check_returncode()
+        return True
 
     except subprocess.CalledProcessError as err:
         print("An error occured:", err.stderr)
+        return False
+
+
+# Functions executed by each stage of the pipeline, given the SRA accession number.
+# They return True if the accession can move on to the next stage.
+
+def prefetch_stage(sra):
+    log(sra, "Retrieving SRA files...")
+    return download_sra(sra)
+
+
+def dump_stage(sra):
+    sra_file = output_dir + "/" + sra + "/*sra*"
+
+    # Wait for enough disk space before expanding the sra file
+    reserve_disk_space(sra, sum(os.path.getsize(file) for file in glob.glob(sra_file)) * args.expansion_factor)
+
+    log(sra, "Retrieving fastq files...")
+    if args.direct_compression:
+        dumped = download_compressed_fastq(sra_file, output_dir + "/" + sra, sra)
+    else:
+        dumped = download_fastq(sra_file, output_dir + "/" + sra)
+
+    # Remove sra files as soon as they are not needed anymore, to free disk space
+    log(sra, "Removing the sra file...")
+    subprocess.run(f"rm {sra_file}", shell = True)
+
+    return dumped
+
+
+def qc_stage(sra):
+    log(sra, "Checking read quality...")
+    if args.direct_compression:
+        return quality_check(output_dir + "/" + sra + "/*fastq.gz")
+    else:
+        return quality_check(output_dir + "/" + sra + "/*fastq")
+
+
+def compress_stage(sra):
+    log(sra, "Gzipping fastq files...")
+    return compress_fastq(output_dir + "/" + sra)
+
+
+# Function to print a message about an accession (workers of different stages print at the same time)
+print_lock = threading.Lock()
+
+def log(sra, message):
+    with print_lock:
+        print(f"-- {sra} -- {message}")
+
+
+# Functions to book and release disk space for an accession, given its projected disk usage (in bytes).
+# Booking blocks until the projected usage fits both in the free space and in what is left of the disk budget.
+disk_condition = threading.Condition()
+disk_reservations = {}
+disk_stats = {"waiting": 0, "waited": 0.0}
+
+def fits_on_disk(projected_usage):
+    if not disk_reservations:
+        return True
+
+    booked = sum(disk_reservations.values())
+    return booked + projected_usage <= disk_budget and projected_usage <= shutil.disk_usage(output_dir).free
+
+
+def reserve_disk_space(sra, projected_usage):
+    with disk_condition:
+        if not fits_on_disk(projected_usage):
+            log(sra, f"Waiting for disk space ({projected_usage / 1e9:.1f} GB needed, "
+                     f"{sum(disk_reservations.values()) / 1e9:.1f} GB booked)...")
+            disk_stats["waiting"] += 1
+            start_time = time.perf_counter()
+
+            # Free space can also change because of other processes, so check again every now and then
+            while not fits_on_disk(projected_usage):
+                disk_condition.wait(timeout = 30)
+
+            disk_stats["waited"] += time.perf_counter() - start_time
+
+        disk_reservations[sra] = projected_usage
+
+
+def release_disk_space(sra):
+    with disk_condition:
+        if disk_reservations.pop(sra, None) is not None:
+            disk_condition.notify_all()
+
+
+# Function to run accessions through a pipeline of stages, given as a list of (name, function, number of workers).
+# Stages are connected by bounded queues, so that a fast stage cannot run too far ahead of the following ones.
+# on_finish is called with each accession leaving the pipeline, either done or failed.
+# Returns the list of failed accessions (with the stage that failed), and, for each stage, the number of accessions
+# processed and the time spent working.
+
+def run_pipeline(accessions, stages, on_finish = None):
+    stage_queues = [queue.Queue()] + [queue.Queue(maxsize = workers) for name, function, workers in stages[1:]]
+    stage_stats = [{"processed": 0, "busy": 0.0} for stage in stages]
+    failed = []
+    stats_lock = threading.Lock()
+
+    def worker(stage_index):
+        name, function, workers = stages[stage_index]
+
+        while True:
+            sra = stage_queues[stage_index].get()
+            if sra is None:
+                break
+
+            start_time = time.perf_counter()
+            try:
+                succeeded = function(sra)
+            except Exception as err:
+                log(sra, f"An error occured: {err}")
+                succeeded = False
+            elapsed = time.perf_counter() - start_time
+
+            with stats_lock:
+                stage_stats[stage_index]["processed"] += 1
+                stage_stats[stage_index]["busy"] += elapsed
+                if not succeeded:
+                    failed.append((sra, name))
+
+            if succeeded and stage_index + 1 < len(stages):
+                stage_queues[stage_index + 1].put(sra)
+                continue
+            elif succeeded:
+                log(sra, "Done")
+
+            if on_finish:
+                on_finish(sra)
+
+    for sra in accessions:
+        stage_queues[0].put(sra)
+
+    stage_threads = []
+    for stage_index, (name, function, workers) in enumerate(stages):
+        threads = [threading.Thread(target = worker, args = (stage_index,)) for i in range(workers)]
+        [thread.start() for thread in threads]
+        stage_threads.append(threads)
+
+    # Once all the workers of a stage have finished, tell the workers of the following stage to stop when done
+    for stage_index, (name, function, workers) in enumerate(stages):
+        if stage_index == 0:
+            [stage_queues[0].put(None) for i in range(workers)]
+
+        [thread.join() for thread in stage_threads[stage_index]]
+
+        if stage_index + 1 < len(stages):
+            [stage_queues[stage_index + 1].put(None) for i in range(stages[stage_index + 1][2])]
+
+    return failed, stage_stats
 
 
 
@@ -123,38 +393,49 @@ print()
 print(f"Read {args.input}: {len(SRA_list)} accession numbers found")
 print()
 
+if args.disk_budget is None:
+    disk_budget = shutil.disk_usage(output_dir).free
+else:
+    disk_budget = args.disk_budget * 1e9
+
+print(f"Disk budget: {disk_budget / 1e9:.1f} GB (expansion factor: {args.expansion_factor})")
+print()
+
 
 ####################################################
 #     Download reads and perform quality check     #
 ####################################################
 
-for SRA in SRA_list:
+STAGES = [("prefetch", prefetch_stage, args.prefetch_jobs),
+          ("fastq-dump", dump_stage, args.dump_jobs),
+          ("fastqc", qc_stage, args.qc_jobs),
+          ("gzip", compress_stage, args.compress_jobs)]
 
-    # Download SRA
-    print(f"-- {SRA} --")
-    print("  Retrieving SRA files...")
-    download_sra(SRA)
+# Fastq files are already compressed by the dump stage
+if args.direct_compression:
+    STAGES = STAGES[:-1]
 
-    # Download fastq
-    SRA_file = output_dir + "/" + SRA + "/*sra*"
-    fastq_output_dir = output_dir + "/" + SRA
-    print("  Retrieving fastq files...")
-    download_fastq(SRA_file)
+start_time = time.perf_counter()
+failed_accessions, stage_stats = run_pipeline(SRA_list, STAGES, on_finish = release_disk_space)
+wall_time = time.perf_counter() - start_time
 
-    # Quality check
-    FASTQ_file = fastq_output_dir + "/*fastq"
-    print("  Checking read quality...")
-    quality_check(FASTQ_file)
+# Report how busy each stage was: the time spent working over the time its workers were available
+print()
+print(f"Processed {len(SRA_list) - len(failed_accessions)} out of {len(SRA_list)} accessions in {wall_time:.1f} s")
+print()
+print("stage\tworkers\taccessions\tbusy_time_s\tutilisation_%")
+for (name, function, workers), stats in zip(STAGES, stage_stats):
+    utilisation = stats["busy"] / (wall_time * workers) * 100 if wall_time else 0
+    print(f"{name}\t{workers}\t{stats['processed']}\t{stats['busy']:.1f}\t{utilisation:.1f}")
 
-    # Gzip fastq files
-    print("  Gzipping fastq files...")
-    subprocess.run(f"gzip -9 {fastq_output_dir}/*fastq",
-                    shell = True)
-    
-    # Remove sra files
-    print("  Removing the sra file...")
-    subprocess.run(f"rm {SRA_file}",
-                    shell = True)
-    
-    print("Done")
+if disk_stats["waiting"]:
     print()
+    print(f"{disk_stats['waiting']} accessions waited for disk space ({disk_stats['waited']:.1f} s in total)")
+
+if failed_accessions:
+    print()
+    for sra, stage in failed_accessions:
+        print(f"{sra} failed at the {stage} stage")
+    sys.exit(1)
+
+print()
@@ -6,12 +6,28 @@
 #   * a fasta file with extracted sequences according to the provided list;
 #   * a list file with sequences that could not be retrieved in the fasta file. 
 #
+# By default, a samtools-compatible index of the fasta file (fasta.fai) is built, or reused if already present, and
+# the requested sequences are read directly from the fasta file through their offsets. In this way, only the requested
+# sequences are loaded in memory, and following runs on the same fasta file do not need to parse it again.
+#
+# If no index is used (--no_index, or a fasta file that cannot be indexed), the fasta file is streamed once and the
+# requested sequences are written as they are found, in the order they appear in the fasta file.
+#
+# Several lists can be extracted at once, either as several list files (-l list1 list2 ...) or as a tsv file with list
+# names on the first column and headers on the second one (-t). The fasta file is read only once, and a fasta file
+# plus a notFound file are written for each list in --output_dir.
+#
+# Gzipped fasta files are supported as well. If BGZF-compressed (e.g., with bgzip), they are indexed like samtools
+# does (fasta.gz.fai and fasta.gz.gzi) and only the blocks containing the requested sequences are decompressed;
+# otherwise they are streamed.
+#
+# Fasta files are read and written by a built-in bytes-level parser, so Biopython is not required.
+#
 #
 # Written by:   Filippo Nicolini
-# Last updated: 18/10/2023
+# Last updated: 18/10/2026
 
-import subprocess, argparse, sys, os
-from Bio import SeqIO
+import subprocess, argparse, sys, os, mmap, gzip, zlib, struct, bisect, functools
 
 
 ##########################################
@@ -22,9 +38,14 @@ from Bio import SeqIO
 parser = argparse.ArgumentParser(description = "Extract sequences from a fasta file given a list of headers.")
 
 # Define some options/arguments/parameters
-parser.add_argument("-l", "--list",
-                    required = True,
-                    help = "The list of fasta headers to be extracted.")
+input_lists = parser.add_mutually_exclusive_group(required = True)
+
+input_lists.add_argument("-l", "--list",
+                         nargs = "+",
+                         help = "The list of fasta headers to be extracted. If several lists are provided, all of them are extracted at once and their outputs are written in --output_dir.")
+
+input_lists.add_argument("-t", "--tsv",
+                         help = "A tsv file with the name of a list on the first column and a fasta header on the second column: each list is extracted at once and its outputs are written in --output_dir.")
 
 parser.add_argument("-f", "--fasta",
                     required = True,
@@ -34,6 +55,15 @@ parser.add_argument("-o", "--output",
                     help = "Name of the output fasta file.",
                     default = "./subsampled_fasta.fasta")
 
+parser.add_argument("-d", "--output_dir",
+                    help = "Name of the output directory, when several lists are extracted. Outputs are named after each list. Default: working directory",
+                    default = "./")
+
+parser.add_argument("-n", "--no_index",
+                    action = "store_true",
+                    help = "Do not build nor use the fasta index (fasta.fai): stream the fasta file once instead. Default: False",
+                    default = False)
+
 # This line checks if the user gave no arguments, and if so then print the help
 parser.parse_args(args = None if sys.argv[1:] else ["--help"])
 
@@ -58,7 +88,280 @@ def extract_sequences(list, fasta):
             sequences_not_found.append(sequence)
 
     return sequences_extracted, sequences_not_found
-    
+
+
+# Function to build a samtools-compatible index of a fasta file.
+# Each line of the index reports: sequence ID, sequence length, offset of the sequence, bases per line, bytes per line.
+# Fasta files whose sequence lines have different lengths cannot be indexed, and a ValueError is raised.
+
+def build_fasta_index(fasta, index):
+    index_lines = []
+    seen = set()
+    record = None
+    offset = 0
+
+    with open_fasta(fasta) as input_fasta:
+        for line in input_fasta:
+            if line.startswith(b">"):
+                if record:
+                    index_lines.append(record)
+
+                name = line[1:].split(None, 1)[0] if line[1:].strip() else b""
+                if name in seen:
+                    # Keep only the first occurrence of duplicated headers
+                    record = None
+                else:
+                    seen.add(name)
+                    # record: [name, length, offset, bases per line, bytes per line, last line reached]
+                    record = [name, 0, offset + len(line), 0, 0, False]
+
+            elif record:
+                bases = len(line.rstrip(b"\r\n"))
+
+                if bases:
+                    if record[5] or (record[3] and (bases > record[3] or (bases == record[3] and len(line) != record[4]))):
+                        raise ValueError(f"{fasta} cannot be indexed: different line lengths in sequence {name.decode()}")
+
+                    if not record[3]:
+                        record[3], record[4] = bases, len(line)
+                    elif bases < record[3]:
+                        record[5] = True
+
+                    record[1] += bases
+
+                else:
+                    record[5] = True
+
+            offset += len(line)
+
+    if record:
+        index_lines.append(record)
+
+    with open(index, 'wb') as output_index:
+        for name, length, sequence_offset, line_bases, line_width, last_line in index_lines:
+            output_index.write(b"%s\t%d\t%d\t%d\t%d\n" % (name, length, sequence_offset, line_bases, line_width))
+
+
+# Function to read a fasta index, keeping only the entries of the selected sequence IDs
+
+def read_fasta_index(index, selected_ids):
+    index_entries = {}
+
+    with open(index) as input_index:
+        for line in input_index:
+            name, length, offset, line_bases, line_width = line.rstrip("\n").split("\t")[:5]
+
+            if name in selected_ids and name not in index_entries:
+                index_entries[name] = (int(length), int(offset), int(line_bases), int(line_width))
+
+    return index_entries
+
+
+# Function to get the header line and the sequence of an indexed record, given a function returning the bytes of the
+# (uncompressed) fasta file between two offsets
+
+def fetch_sequence(read_region, index_entry):
+    length, offset, line_bases, line_width = index_entry
+
+    # The header is the line just before the sequence: look for it in a growing window
+    window = 1024
+    while True:
+        window_start = max(0, offset - window)
+        preceding_bytes = read_region(window_start, offset)
+        header_start = preceding_bytes.rfind(b"\n", 0, len(preceding_bytes) - 1) + 1
+
+        if header_start or window_start == 0:
+            break
+        window *= 8
+
+    header = preceding_bytes[header_start + 1:].rstrip()
+
+    if length:
+        full_lines, last_line_bases = divmod(length, line_bases)
+        sequence = read_region(offset, offset + full_lines * line_width + last_line_bases)
+    else:
+        sequence = b""
+
+    return header, sequence.translate(None, b"\r\n ")
+
+
+# Function to tell whether a file is gzipped, and whether it is BGZF-compressed (i.e., blocked gzip, as produced by
+# bgzip, which can be randomly accessed)
+
+def get_compression(filename):
+    with open(filename, 'rb') as input_file:
+        gzip_header = input_file.read(18)
+
+    if not gzip_header.startswith(b"\x1f\x8b"):
+        return None
+
+    # BGZF blocks are gzip members with a "BC" extra subfield storing the size of the block
+    if len(gzip_header) == 18 and gzip_header[3] & 4 and gzip_header[12:14] == b"BC":
+        return "bgzf"
+
+    return "gzip"
+
+
+# Function to open a fasta file in binary mode, either plain or gzipped
+
+def open_fasta(fasta):
+    if get_compression(fasta):
+        return gzip.open(fasta, 'rb')
+
+    return open(fasta, 'rb')
+
+
+# Function to read a fasta file (opened in binary mode) in large chunks, yielding (header, sequence) tuples of bytes.
+# Headers are stripped of ">" and of trailing whitespaces, sequences are stripped of newlines and spaces; anything
+# before the first header is ignored.
+
+def read_fasta(input_fasta, chunk_size = 1 << 22):
+    # Chunks not yet split into records, starting with a virtual newline so that records are always preceded by "\n>"
+    pending = [b"\n"]
+
+    # The first piece is whatever comes before the first header
+    skip_first_piece = True
+
+    while True:
+        chunk = input_fasta.read(chunk_size)
+
+        # Long sequences may span several chunks: only split when a new record starts
+        if chunk and b"\n>" not in chunk and not (chunk.startswith(b">") and pending[-1].endswith(b"\n")):
+            pending.append(chunk)
+            continue
+
+        pending.append(chunk)
+        records = b"".join(pending).split(b"\n>")
+
+        # The last record may continue in the next chunk
+        pending = [records.pop()] if chunk else []
+
+        for record in records:
+            if skip_first_piece:
+                skip_first_piece = False
+                continue
+
+            header_end = record.find(b"\n")
+            if header_end == -1:
+                yield record.rstrip(), b""
+            else:
+                yield record[:header_end].rstrip(), record[header_end + 1:].translate(None, b"\r\n ")
+
+        if not chunk:
+            break
+
+
+# Function to write a record in fasta format, with the whole sequence on a single line
+
+def write_fasta(output_file, header, sequence):
+    output_file.write(b">" + header + b"\n" + sequence + b"\n")
+
+
+# Function to build a samtools-compatible index of the blocks of a BGZF file.
+# The index is a binary file with the number of blocks after the first one, followed by the compressed and
+# uncompressed offsets of each of them, all as little-endian unsigned 64-bit integers.
+
+def build_bgzf_index(bgzf_file, index):
+    block_offsets = []
+    compressed_offset = uncompressed_offset = 0
+
+    with open(bgzf_file, 'rb') as input_bgzf:
+        while True:
+            block_header = input_bgzf.read(12)
+            if not block_header:
+                break
+
+            # Look for the size of the block among the extra subfields
+            extra_length = struct.unpack("<H", block_header[10:12])[0]
+            extra = input_bgzf.read(extra_length)
+            block_size = None
+            position = 0
+            while position < extra_length:
+                subfield_id, subfield_length = extra[position:position + 2], struct.unpack("<H", extra[position + 2:position + 4])[0]
+                if subfield_id == b"BC":
+                    block_size = struct.unpack("<H", extra[position + 4:position + 6])[0] + 1
+                position += 4 + subfield_length
+
+            if not block_header.startswith(b"\x1f\x8b") or block_size is None:
+                raise ValueError(f"{bgzf_file} is not a valid BGZF file")
+
+            # The uncompressed size of the block is stored in its last four bytes
+            input_bgzf.seek(compressed_offset + block_size - 4)
+            uncompressed_size = struct.unpack("<I", input_bgzf.read(4))[0]
+
+            if compressed_offset:
+                block_offsets.append((compressed_offset, uncompressed_offset))
+
+            compressed_offset += block_size
+            uncompressed_offset += uncompressed_size
+
+    with open(index, 'wb') as output_index:
+        output_index.write(struct.pack("<Q", len(block_offsets)))
+        for offsets in block_offsets:
+            output_index.write(struct.pack("<QQ", *offsets))
+
+
+# Function to read a BGZF index into two sorted lists: uncompressed and compressed offsets of each block
+
+def read_bgzf_index(index):
+    with open(index, 'rb') as input_index:
+        n_blocks = struct.unpack("<Q", input_index.read(8))[0]
+        offsets = struct.unpack(f"<{2 * n_blocks}Q", input_index.read(16 * n_blocks))
+
+    return [0] + list(offsets[1::2]), [0] + list(offsets[0::2])
+
+
+# Function to decompress the BGZF block starting at a given compressed offset (recently used blocks are kept in memory)
+
+@functools.lru_cache(maxsize = 64)
+def read_bgzf_block(input_bgzf, compressed_offset):
+    input_bgzf.seek(compressed_offset)
+    block_header = input_bgzf.read(18)
+    block_size = struct.unpack("<H", block_header[16:18])[0] + 1
+
+    return zlib.decompress(block_header + input_bgzf.read(block_size - 18), 31)
+
+
+# Function to read the bytes of a BGZF file between two uncompressed offsets, decompressing only the blocks involved
+
+def read_bgzf_region(input_bgzf, uncompressed_offsets, compressed_offsets, start, end):
+    block = bisect.bisect_right(uncompressed_offsets, start) - 1
+    position = uncompressed_offsets[block]
+    region = []
+
+    while position < end and block < len(compressed_offsets):
+        block_data = read_bgzf_block(input_bgzf, compressed_offsets[block])
+        region.append(block_data[max(0, start - position):end - position])
+        position += len(block_data)
+        block += 1
+
+    return b"".join(region)
+
+
+# Function to extract sequences from fasta in a single pass over the fasta file, given a dictionary with the output
+# files where each header is to be written (i.e., the lists it belongs to).
+# Matching sequences are written as soon as they are found (only the first occurrence of duplicated headers), and the
+# fasta file is read only until all the headers have been found.
+
+def stream_sequences(header_outputs, fasta):
+    sequences_found = set()
+    headers_to_find = len(header_outputs)
+
+    with open_fasta(fasta) as input_fasta:
+        for header, sequence in read_fasta(input_fasta):
+            sequence_id = header.split(None, 1)[0] if header else b""
+            output_files = header_outputs.get(sequence_id)
+
+            if output_files and sequence_id not in sequences_found:
+                for output_file in output_files:
+                    write_fasta(output_file, header, sequence)
+                sequences_found.add(sequence_id)
+
+                if len(sequences_found) == headers_to_find:
+                    break
+
+    return sequences_found
+
 
 #------------------------------------------------------------------------------------------
 
@@ -67,46 +370,158 @@ def extract_sequences(list, fasta):
 #     Read input files     #
 ############################
 
-# Read in header list
-print()
-print(f"Reading {args.list}...")
-
-header_list = []
-with open(args.list) as input_list:
-    [header_list.append(line.strip()) for line in input_list.readlines()]
+# Read in header list(s): a dictionary with list names as keys and lists of headers as values
+header_lists = {}
+
+if args.tsv:
+    print()
+    print(f"Reading {args.tsv}...")
+
+    with open(args.tsv) as input_tsv:
+        for line_number, line in enumerate(input_tsv, start = 1):
+            if line.strip():
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 2:
+                    sys.exit(f"ERROR: line {line_number} of {args.tsv} is not made of a list name and a header separated by a tab.")
+
+                list_name, header = fields[:2]
+                header_lists.setdefault(list_name.strip(), []).append(header.strip())
+
+else:
+    # Lists are named after their file name. List files with the same name (e.g., og1/ids.txt and og2/ids.txt) are
+    # named after their parent directory as well
+    file_names = [os.path.splitext(os.path.basename(list_file))[0] for list_file in args.list]
+    list_names = [os.path.basename(os.path.dirname(os.path.abspath(list_file))) + "_" + file_name if file_names.count(file_name) > 1 else file_name
+                  for list_file, file_name in zip(args.list, file_names)]
+
+    if len(set(list_names)) < len(list_names):
+        sys.exit("ERROR: some list files have the same name and parent directory, so their outputs would overwrite each other. Please rename them.")
+
+    for list_name, list_file in zip(list_names, args.list):
+        print()
+        print(f"Reading {list_file}...")
+
+        header_list = []
+        with open(list_file) as input_list:
+            [header_list.append(line.strip()) for line in input_list.readlines()]
+
+        header_lists[list_name] = header_list
+
+# Define the name of the output files of each list: a single list is written to --output, as usual
+output_filenames = {}
+
+if not args.tsv and len(args.list) == 1:
+    output_filenames[list(header_lists)[0]] = args.output
+else:
+    os.makedirs(args.output_dir, exist_ok = True)
+    for list_name in header_lists:
+        output_filenames[list_name] = os.path.join(args.output_dir, list_name + ".fasta")
+
+# Invert the lists, so that each header is looked up only once whatever the number of lists it belongs to
+header_to_lists = {}
+for list_name, header_list in header_lists.items():
+    for header in header_list:
+        if header and list_name not in header_to_lists.setdefault(header, []):
+            header_to_lists[header].append(list_name)
+
+print(f"    Attempting to extract {sum(len(header_list) for header_list in header_lists.values())} fasta sequences "
+      f"({len(header_to_lists)} unique) from {args.fasta}, in {len(header_lists)} list(s).")
+
+# Build the fasta index, or reuse it if it is up to date.
+# Gzipped fasta files can only be indexed if BGZF-compressed: in this case an index of the blocks is needed as well.
+index_entries = None
+COMPRESSION = get_compression(args.fasta)
+
+if COMPRESSION == "gzip" and not args.no_index:
+    print(f"    {args.fasta} is gzipped but not BGZF-compressed, so it cannot be indexed: it will be streamed instead. "
+          "Compress it with \"bgzip\" to allow random access.")
+
+elif not args.no_index:
+    fasta_index = args.fasta + ".fai"
+    bgzf_index = args.fasta + ".gzi"
+    index_being_built = None
+
+    try:
+        if COMPRESSION == "bgzf":
+            if os.path.isfile(bgzf_index) and os.path.getmtime(bgzf_index) >= os.path.getmtime(args.fasta):
+                print(f"    Using the BGZF index {bgzf_index}.")
+            else:
+                print(f"    Indexing BGZF blocks of {args.fasta}...")
+                index_being_built = bgzf_index
+                build_bgzf_index(args.fasta, bgzf_index)
+                index_being_built = None
+
+        if os.path.isfile(fasta_index) and os.path.getmtime(fasta_index) >= os.path.getmtime(args.fasta):
+            print(f"    Using the fasta index {fasta_index}.")
+        else:
+            print(f"    Indexing {args.fasta}...")
+            index_being_built = fasta_index
+            build_fasta_index(args.fasta, fasta_index)
+            index_being_built = None
 
-print(f"    Attempting to extract {len(header_list)} fasta sequences from {args.fasta}.")
+        index_entries = read_fasta_index(fasta_index, header_to_lists.keys())
 
-# Read in fasta file and remove sequences with duplicated header
-seen = {}
-input_fasta = []
-for sequence in SeqIO.parse(args.fasta, "fasta"):
-    if str(sequence.id) not in seen:
-        input_fasta.append(sequence)
-        seen[(str(sequence.id))] = ""
+    # Ragged fasta files cannot be indexed, and indexes cannot be written next to fasta files in read-only directories
+    except (ValueError, OSError) as err:
+        print(f"    {err}. The fasta file will be streamed instead.")
+        index_entries = None
 
-input_fasta_dict = SeqIO.to_dict(input_fasta)
+        # Do not leave a partially written index, which would look up to date to the following runs
+        if index_being_built:
+            try:
+                os.remove(index_being_built)
+            except OSError:
+                pass
 
 
 #################################################
 #     Extract selected sequences from fasta     #
 #################################################
 
-sequences_extracted_dict,sequences_not_found_list = extract_sequences(header_list, input_fasta_dict)
+# With the index, only collect the offsets of the sequences of each list...
+if index_entries is not None:
+    extraction_results = {list_name: extract_sequences(header_list, index_entries)
+                          for list_name, header_list in header_lists.items()}
 
-print(f"    {len(sequences_extracted_dict)} "
-      f"({round(len(sequences_extracted_dict)/len(header_list)*100, 2)}%) "
-      "sequences were actually extracted.")
+# ...else stream the fasta file once, writing each sequence to the output files of all the lists it belongs to
+else:
+    print(f"    Streaming {args.fasta}...")
 
-try:
-    notFound_filename = os.path.splitext(args.output)[0] + "_notFound.ls"
-except:
-    notFound_filename = args.output + "_notFound.ls"
+    output_files = {list_name: open(output_filenames[list_name], 'wb') for list_name in header_lists}
+    try:
+        header_outputs = {header.encode(): [output_files[list_name] for list_name in list_names]
+                          for header, list_names in header_to_lists.items()}
+        sequences_found = {header.decode() for header in stream_sequences(header_outputs, args.fasta)}
+    finally:
+        for output_file in output_files.values():
+            output_file.close()
 
-if not len(sequences_not_found_list) == 0:
-    print(f"    {len(sequences_not_found_list)} "
-          f"({round(len(sequences_not_found_list)/len(header_list)*100, 2)}%) "
-          f"were not present in the fasta file. If you want to check them, see {notFound_filename}.")
+    extraction_results = {}
+    for list_name, header_list in header_lists.items():
+        extraction_results[list_name] = (dict.fromkeys(header for header in header_list if header in sequences_found),
+                                         [header for header in header_list if header not in sequences_found])
+
+notFound_filenames = {}
+for list_name, (sequences_extracted_dict, sequences_not_found_list) in extraction_results.items():
+    header_list = header_lists[list_name]
+
+    try:
+        notFound_filename = os.path.splitext(output_filenames[list_name])[0] + "_notFound.ls"
+    except:
+        notFound_filename = output_filenames[list_name] + "_notFound.ls"
+    notFound_filenames[list_name] = notFound_filename
+
+    if len(header_lists) > 1 or args.tsv:
+        print(f"  {list_name}:")
+
+    print(f"    {len(sequences_extracted_dict)} "
+          f"({round(len(sequences_extracted_dict)/len(header_list)*100, 2)}%) "
+          "sequences were actually extracted.")
+
+    if not len(sequences_not_found_list) == 0:
+        print(f"    {len(sequences_not_found_list)} "
+              f"({round(len(sequences_not_found_list)/len(header_list)*100, 2)}%) "
+              f"were not present in the fasta file. If you want to check them, see {notFound_filename}.")
 
 
 ##########################################
@@ -115,8 +530,27 @@ if not len(sequences_not_found_list) == 0:
 
 print("Creating output files...")
 
-with open(args.output, 'w') as output_file:
-    SeqIO.write(sequences_extracted_dict.values(), output_file, "fasta-2line")
-
-with open(notFound_filename, 'w') as notFound_file:
-    [notFound_file.write(f"{line}\n") for line in sequences_not_found_list]
+# Read the indexed sequences one at a time, either out of the memory-mapped fasta file or out of the BGZF blocks
+# (streamed sequences have already been written)
+if index_entries is not None:
+    with open(args.fasta, 'rb') as input_fasta:
+        mapped_fasta = None
+
+        if COMPRESSION == "bgzf":
+            uncompressed_offsets, compressed_offsets = read_bgzf_index(bgzf_index)
+            read_region = lambda start, end: read_bgzf_region(input_fasta, uncompressed_offsets, compressed_offsets, start, end)
+        elif index_entries:
+            mapped_fasta = mmap.mmap(input_fasta.fileno(), 0, access = mmap.ACCESS_READ)
+            read_region = lambda start, end: mapped_fasta[start:end]
+
+        for list_name, (sequences_extracted_dict, sequences_not_found_list) in extraction_results.items():
+            with open(output_filenames[list_name], 'wb') as output_file:
+                for index_entry in sequences_extracted_dict.values():
+                    write_fasta(output_file, *fetch_sequence(read_region, index_entry))
+
+        if mapped_fasta is not None:
+            mapped_fasta.close()
+
+for list_name, (sequences_extracted_dict, sequences_not_found_list) in extraction_results.items():
+    with open(notFound_filenames[list_name], 'w') as notFound_file:
+        [notFound_file.write(f"{line}\n") for line in sequences_not_found_list]
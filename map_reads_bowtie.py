@@ -1,7 +1,7 @@
 #!/bin/env python3
 
 # Given a directory containing paired and trimmed fastq files, this script map reads against a reference transcriptome.
-# REQUIRED SOFTWARES: bowtie2
+# REQUIRED SOFTWARES: bowtie2, samtools
 #
 # Note that the structure of the input directory should be as follow:
 # AccNo/
@@ -12,20 +12,37 @@
 # The script creates an output directory structured as follow:
 # ./
 # └── your_output_dir/
-#     ├── AccNo.mapped.bam
+#     ├── AccNo.mapped.bam                      (only with --keep_unsorted_bam)
 #     ├── AccNo.mapped.log
 #     ├── AccNo.mapped.sorted.filtered.bam
 #     ├── AccNo.mapped.sorted.filtered.bam.bai
 #     └── AccNo.rawmapping.stats.tsv
 #
+# Alignments are streamed from bowtie2 to samtools, which drops unmapped reads and sorts the remaining ones by
+# coordinate, so that no sam file is written and the sorted, filtered bam is written only once.
+#
+# Bowtie2 indexes are kept in a shared store (--index_store), in a directory named after the sha256 of the reference
+# fasta file, so that each reference is indexed only once whatever its name and location. When several jobs need the
+# same missing index, a lock file makes one of them build it while the others wait. Indexes are built in a temporary
+# directory which is renamed when complete, and all their parts are checked before use.
+#
+# Several input directories can be given at once. Samples are then mapped at the same time (--jobs), sharing a total
+# number of cores (--cores, by default the cores this process is allowed to run on, taking into account the CPU limits
+# of its cgroup): each sample gets an equal share, split between bowtie2 and samtools sort. Bowtie2 runs with --mm, so
+# that concurrent processes share the memory-mapped index instead of loading a copy each. Wall and CPU time of each
+# sample are reported at the end.
+#
+# Raw counts statistics of many samples can then be merged into a count matrix with aggregate_rawcounts.py.
+#
 #
 # Written by:   Filippo Nicolini
-# Last updated: 17/11/2023
+# Last updated: 18/10/2026
 #
 #------------------------------------------------------------------
 
 
-import subprocess, argparse, sys, os
+import subprocess, argparse, sys, os, hashlib, fcntl, tempfile, shutil, threading, time
+from concurrent.futures import ThreadPoolExecutor
 
 
 ############################################
@@ -36,9 +53,14 @@ import subprocess, argparse, sys, os
 parser = argparse.ArgumentParser(description = "Map reads against a reference transcriptome using bowtie, than index and sort the resulting bam file.")
 
 # Define some options/arguments/parameters
-parser.add_argument("-d", "--input_dir", required = True, help = "Directory containing trimmed paired fastq files to map. Note that the structure of input directory should be as follow: input_dir/{input_dir_1.fastq.gz, input_dir_2.fastq.gz}")
+parser.add_argument("-d", "--input_dir", required = True, nargs = "+", help = "Directories containing trimmed paired fastq files to map. Note that the structure of input directories should be as follow: input_dir/{input_dir_1.fastq.gz, input_dir_2.fastq.gz}")
 parser.add_argument("-ref", "--reference_transcriptome", required = True, help = "Reference transcriptome used to map reads.")
 parser.add_argument("-o", "--output_dir", help = "Name of the output directory.")
+parser.add_argument("--index_store", default = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "bowtie2_indexes"), help = "Directory where bowtie2 indexes are stored, shared by all the runs. Default: ~/.cache/bowtie2_indexes")
+parser.add_argument("-c", "--cores", type = int, default = None, help = "Total number of cores to use. Default: cores available to this process (CPU affinity and cgroup limits)")
+parser.add_argument("-j", "--jobs", type = int, default = None, help = "Number of samples to map at the same time, sharing the cores. Default: one every 16 cores")
+parser.add_argument("--index_threads", type = int, default = None, help = "Number of threads used to build a missing bowtie2 index. Default: all the cores")
+parser.add_argument("--keep_unsorted_bam", action = "store_true", default = False, help = "Also write all the alignments (mapped and unmapped reads) to an unsorted AccNo.mapped.bam. Default: False")
 
 # This line checks if the user gave no arguments, and if so then print the help
 parser.parse_args(args = None if sys.argv[1:] else ["--help"])
@@ -51,62 +73,204 @@ args = parser.parse_args()
 #     Defining functions to map reads     #
 ###########################################
 
-# Function to index the reference transcriptome
-def index_transcriptome(transcriptome):
+# Function to get the number of cores available to this process: the CPUs it can be scheduled on, capped by the CPU
+# quota of its cgroup (cgroup v2 cpu.max, or cgroup v1 cpu.cfs_quota_us/cpu.cfs_period_us), if any
+def get_available_cores():
+    cores = len(os.sched_getaffinity(0))
+
     try:
-        bowtiebuild_process = subprocess.run(f"bowtie2-build {transcriptome} {transcriptome}",
-                                             shell = True)
-    except:
-        print("An error occured:", err.stderr)
+        with open("/sys/fs/cgroup/cpu.max") as cpu_max:
+            quota, period = cpu_max.read().split()
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as quota_file, open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as period_file:
+                quota, period = quota_file.read().strip(), period_file.read().strip()
+        except OSError:
+            quota, period = "max", "1"
+
+    if quota not in ("max", "-1"):
+        cores = min(cores, max(1, int(int(quota) / int(period))))
+
+    return cores
+
+# Function to run a shell command with bash, like subprocess.run, also measuring the CPU time used by the command and
+# all its child processes (os.wait4 returns the resource usage of the waited process and of the children it waited for)
+def run_timed(command):
+    process = subprocess.Popen(command,
+                               shell = True,
+                               executable = "/bin/bash",
+                               stdout = subprocess.PIPE,
+                               stderr = subprocess.PIPE,
+                               text = True)
+
+    # Both pipes are read at the same time, as communicate() does, so that a command filling the stderr pipe cannot
+    # block while stdout is being read. communicate() itself cannot be used, since it reaps the process before wait4.
+    stderr_lines = []
+    stderr_thread = threading.Thread(target = lambda: stderr_lines.append(process.stderr.read()))
+    stderr_thread.start()
+    stdout = process.stdout.read()
+    stderr_thread.join()
+    stderr = stderr_lines[0]
+    process.stdout.close()
+    process.stderr.close()
+
+    pid, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    completed_process = subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
+    completed_process.cpu_time = rusage.ru_utime + rusage.ru_stime
+    return completed_process
 
-def map_reads(input_directory, acc, indexed_transcriptome, output_directory):
+# Function to print a message about a sample (samples are mapped at the same time)
+print_lock = threading.Lock()
+
+def log(acc, message):
+    with print_lock:
+        print(f"-- {acc} -- {message}")
+
+# Parts of a bowtie2 index (large indexes end with .bt2l instead of .bt2)
+INDEX_PARTS = [".1", ".2", ".3", ".4", ".rev.1", ".rev.2"]
+
+# Function to get the sha256 of the reference transcriptome
+def get_reference_hash(transcriptome):
+    reference_hash = hashlib.sha256()
+    with open(transcriptome, 'rb') as transcriptome_file:
+        for block in iter(lambda: transcriptome_file.read(1 << 20), b""):
+            reference_hash.update(block)
+
+    return reference_hash.hexdigest()
+
+# Function to check that all the parts of a bowtie2 index are there and not empty, given its prefix
+def is_index_complete(index_prefix):
+    for extension in (".bt2", ".bt2l"):
+        if all(os.path.isfile(index_prefix + part + extension) and os.path.getsize(index_prefix + part + extension) > 0
+               for part in INDEX_PARTS):
+            return True
+
+    return False
+
+# Function to index the reference transcriptome, given the prefix of the index
+def index_transcriptome(transcriptome, index_prefix, threads):
     try:
-        bowtie_process = subprocess.run(f"bowtie2 -x {indexed_transcriptome} "
-                                        f"-1 {input_directory}/{acc}_1_paired.fastq.gz -2 {input_directory}/{acc}_2_paired.fastq.gz "
-                                        f"-S {output_directory}/{acc}.mapped.sam --no-discordant -p 30 "
-                                        f"2> {output_directory}/{acc}.mapped.log",
-                                        shell = True,
-                                        capture_output = True,
-                                        text = True)
-        bowtie_process.check_returncode()
-        
+        bowtiebuild_process = subprocess.run(f"bowtie2-build --threads {threads} {transcriptome} {index_prefix}",
+                                             shell = True,
+                                             capture_output = True,
+                                             text = True)
+        bowtiebuild_process.check_returncode()
+        return True
+
     except subprocess.CalledProcessError as err:
         print("An error occured:", err.stderr)
+        return False
+
+# Function to get the bowtie2 index of the reference transcriptome from the index store, building it if missing.
+# Returns the index prefix, or None if the index could not be built.
+def get_index(transcriptome, index_store, threads):
+    reference_hash = get_reference_hash(transcriptome)
+    index_dir = f"{index_store}/{reference_hash}"
+    index_prefix = f"{index_dir}/index"
+
+    if is_index_complete(index_prefix):
+        return index_prefix
+
+    os.makedirs(index_store, exist_ok = True)
 
-def from_sam_to_rawcounts(sam_file, acc, indexed_transcriptome, output_directory):
+    # Only one job at a time can build the index: the others wait here, and then find it complete
+    with open(f"{index_store}/{reference_hash}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        if is_index_complete(index_prefix):
+            return index_prefix
+
+        # Leftovers of an interrupted build
+        if os.path.isdir(index_dir):
+            shutil.rmtree(index_dir)
+
+        print(f"Indexing reference transcriptome in {index_dir}/...")
+        tmp_index_dir = tempfile.mkdtemp(prefix = f".tmp.{reference_hash}.", dir = index_store)
+        try:
+            if not index_transcriptome(transcriptome, f"{tmp_index_dir}/index", threads) or not is_index_complete(f"{tmp_index_dir}/index"):
+                return None
+
+            with open(f"{tmp_index_dir}/reference.txt", "w") as reference_file:
+                reference_file.write(os.path.abspath(transcriptome) + "\n")
+
+            os.rename(tmp_index_dir, index_dir)
+
+        finally:
+            if os.path.isdir(tmp_index_dir):
+                shutil.rmtree(tmp_index_dir)
+
+    return index_prefix
+
+# Function to map reads, given a directory containing paired fastq files.
+# Bowtie2 output is piped into samtools, which filters out unmapped reads (-F 4) and sorts the alignments by coordinate.
+# With --keep_unsorted_bam, tee also sends all the alignments to a separate samtools process writing AccNo.mapped.bam.
+# Returns the CPU time used, or None if something went wrong.
+def map_reads(input_directory, acc, indexed_transcriptome, output_directory, bowtie_threads, sort_threads):
     output_acc = output_directory + "/" + acc
 
+    # The process writing the unsorted bam file is not part of the pipeline, so it is started by the outer shell on file
+    # descriptor 3, which tee writes to. Once the pipeline is over, the descriptor is closed and the exit status of the
+    # writer is checked too, so that a truncated AccNo.mapped.bam is not reported as done.
+    if args.keep_unsorted_bam:
+        start_unsorted_bam = f"exec 3> >(samtools view -b -o {output_acc}.mapped.bam -); unsorted_bam_pid=$!; "
+        keep_unsorted_bam = "tee /dev/fd/3 | "
+        wait_unsorted_bam = "; status=$?; exec 3>&-; wait $unsorted_bam_pid || status=1; exit $status"
+    else:
+        start_unsorted_bam = keep_unsorted_bam = wait_unsorted_bam = ""
+
     try:
-        # Generate bam file from sam file
-        generate_bam_process = subprocess.run(f"samtools view -b {sam_file} > {output_acc}.mapped.bam",
-                                              shell = True,
-                                              capture_output = True,
-                                              text = True)
-        generate_bam_process.check_returncode()
-        
-        # Remove sam file
-        subprocess.run(f"rm {output_acc}.mapped.sam", shell = True)
-
-        # Sort and filter bam file
-        sort_n_filter_process = subprocess.run(f"samtools sort -@ 30 {output_acc}.mapped.bam | "
-                                               f"samtools view -b -t {indexed_transcriptome} -F 4 -h -@ 30 "
-                                               f"> {output_acc}.mapped.sorted.filtered.bam",
-                                               shell = True,
-                                               capture_output = True,
-                                               text = True)
-        sort_n_filter_process.check_returncode()
-        
-        # Get raw counts statistics out of bam file
-        get_rowcounts_process = subprocess.run(f"samtools index {output_acc}.mapped.sorted.filtered.bam && "
-                                               f"samtools idxstats {output_acc}.mapped.sorted.filtered.bam "
-                                               f"> {output_acc}.rawmapping.stats.tsv",
-                                               shell = True,
-                                               capture_output = True,
-                                               text = True)
+        mapping_process = run_timed("set -o pipefail; "
+                                    f"{start_unsorted_bam}"
+                                    f"bowtie2 -x {indexed_transcriptome} --mm "
+                                    f"-1 {input_directory}/{acc}_1_paired.fastq.gz -2 {input_directory}/{acc}_2_paired.fastq.gz "
+                                    f"--no-discordant -p {bowtie_threads} 2> {output_acc}.mapped.log | "
+                                    f"{keep_unsorted_bam}"
+                                    "samtools view -u -F 4 -h - | "
+                                    f"samtools sort -@ {sort_threads} -T {output_acc}.sort.tmp -o {output_acc}.mapped.sorted.filtered.bam -"
+                                    f"{wait_unsorted_bam}")
+        mapping_process.check_returncode()
+        return mapping_process.cpu_time
+
+    except subprocess.CalledProcessError as err:
+        print("An error occured:", err.stderr, f"(bowtie2 log: {output_acc}.mapped.log)")
+        return None
+
+# Function to get raw counts statistics out of the sorted bam file.
+# Returns the CPU time used, or None if something went wrong.
+def get_rawcounts(acc, output_directory):
+    output_acc = output_directory + "/" + acc
+
+    try:
+        get_rowcounts_process = run_timed(f"samtools index {output_acc}.mapped.sorted.filtered.bam && "
+                                          f"samtools idxstats {output_acc}.mapped.sorted.filtered.bam "
+                                          f"> {output_acc}.rawmapping.stats.tsv")
         get_rowcounts_process.check_returncode()
+        return get_rowcounts_process.cpu_time
     
     except subprocess.CalledProcessError as err:
         print("An error occured:", err.stderr)
+        return None
+
+# Function to map the reads of a sample and get its raw counts, given its input directory.
+# Returns the accession number, whether it succeeded, and its wall and CPU time.
+def process_sample(input_directory):
+    acc = os.path.basename(os.path.normpath(input_directory))
+    start_time = time.perf_counter()
+
+    log(acc, f"Mapping, filtering and sorting reads ({BOWTIE_THREADS} bowtie2 threads, {SORT_THREADS} samtools threads)...")
+    mapping_cpu_time = map_reads(input_directory, acc, INDEX_PREFIX, args.output_dir, BOWTIE_THREADS, SORT_THREADS)
+    if mapping_cpu_time is None:
+        return acc, False, time.perf_counter() - start_time, 0.0
+
+    log(acc, "Getting raw counts...")
+    rawcounts_cpu_time = get_rawcounts(acc, args.output_dir)
+    if rawcounts_cpu_time is None:
+        return acc, False, time.perf_counter() - start_time, mapping_cpu_time
+
+    log(acc, "Done")
+    return acc, True, time.perf_counter() - start_time, mapping_cpu_time + rawcounts_cpu_time
 
 
 
@@ -114,11 +278,13 @@ def from_sam_to_rawcounts(sam_file, acc, indexed_transcriptome, output_directory
 #     Map reads     #
 #####################
 
-# Define a variable to store the accession number of your run
-if not os.path.basename(args.input_dir):
-    ACC = os.path.basename(args.input_dir[:-1])
-else:
-    ACC = os.path.basename(args.input_dir)
+# Split the core budget across the samples mapped at the same time, and then between bowtie2 and samtools sort
+TOTAL_CORES = args.cores if args.cores else get_available_cores()
+JOBS = args.jobs if args.jobs else max(1, TOTAL_CORES // 16)
+JOBS = max(1, min(JOBS, len(args.input_dir), TOTAL_CORES))
+SAMPLE_THREADS = TOTAL_CORES // JOBS
+SORT_THREADS = max(1, SAMPLE_THREADS // 4)
+BOWTIE_THREADS = max(1, SAMPLE_THREADS - SORT_THREADS)
 
 
 # Create output directory
@@ -128,24 +294,35 @@ if not os.path.isdir(args.output_dir):
     subprocess.run(f"mkdir {args.output_dir}", shell = True)
 
 
-# Index the reference transcriptome
-if not any(file.endswith(".bt2") for file in os.listdir(os.path.dirname(args.reference_transcriptome))):
-    print("Indexing reference transcriptome...")
-    index_transcriptome(args.reference_transcriptome)
+# Get the index of the reference transcriptome
+INDEX_PREFIX = get_index(args.reference_transcriptome, args.index_store, args.index_threads if args.index_threads else TOTAL_CORES)
+if INDEX_PREFIX is None:
+    sys.exit(1)
 
 
-# Map reads
+# Map reads, filter and sort alignments, and get raw count statistics
+print()
+print(f"Mapping {len(args.input_dir)} samples on {TOTAL_CORES} cores ({JOBS} samples of {SAMPLE_THREADS} threads at a time)")
 print()
-print(f"-- {ACC} --")
-print("  Mapping reads...")
-map_reads(args.input_dir, ACC, args.reference_transcriptome, args.output_dir)
 
+start_time = time.perf_counter()
+with ThreadPoolExecutor(max_workers = JOBS) as executor:
+    results = list(executor.map(process_sample, args.input_dir))
+wall_time = time.perf_counter() - start_time
 
-# Convert to bam and get raw count statistics
-SAM_file = args.output_dir + "/" + ACC + ".mapped.sam"
+# Report wall and CPU time of each sample: CPU efficiency is the CPU time over the time its threads were available
+print()
+print("sample\tstatus\twall_time_s\tcpu_time_s\tcpu_efficiency_%")
+for acc, succeeded, sample_wall_time, sample_cpu_time in results:
+    efficiency = sample_cpu_time / (sample_wall_time * SAMPLE_THREADS) * 100 if sample_wall_time else 0
+    print(f"{acc}\t{'done' if succeeded else 'failed'}\t{sample_wall_time:.1f}\t{sample_cpu_time:.1f}\t{efficiency:.1f}")
 
-print("  Converting sam to bam and getting raw counts...")
-from_sam_to_rawcounts(SAM_file, ACC, args.reference_transcriptome, args.output_dir)
+failed_samples = [acc for acc, succeeded, sample_wall_time, sample_cpu_time in results if not succeeded]
+
+print()
+print(f"Mapped {len(results) - len(failed_samples)} out of {len(results)} samples in {wall_time:.1f} s")
+if failed_samples:
+    print("Failed samples: " + ", ".join(failed_samples))
+    sys.exit(1)
 
-print("Done")
 print()
@@ -1,6 +1,6 @@
 #!/bin/env python3
 
-# Given a directory containing paired and trimmed fastq files, this script maps reads against a reference genome, also modeling intron splits.
+# Given one or more directories containing paired and trimmed fastq files, this script maps reads against a reference genome, also modeling intron splits.
 # REQUIRED SOFTWARES: STAR
 #
 # Note that the structure of the input directory should be as follow:
@@ -20,14 +20,21 @@
 #     ├── AccNo_trimmed_SJ.out.tab
 #     └── AccNo_trimmed__STARgenome
 #
+# When several input directories are given, the genome index is loaded only once into shared memory
+# (--genomeLoad LoadAndExit), and all the samples are aligned against it (--genomeLoad LoadAndKeep), --jobs at a time,
+# sharing --threads. The genome is removed from shared memory at the end, even if something fails or the script is
+# terminated. Note that, in this case, splice junctions are taken from the annotation used to build the index (they
+# cannot be inserted on the fly), and sorting bam files is limited to --limit_bam_sort_ram bytes per sample.
+#
 #
 # Written by:   Filippo Nicolini
-# Last updated: 15/01/2023
+# Last updated: 18/10/2026
 #
 #------------------------------------------------------------------
 
 
-import subprocess, argparse, sys, os
+import subprocess, argparse, sys, os, signal
+from concurrent.futures import ThreadPoolExecutor
 
 
 ############################################
@@ -39,7 +46,8 @@ parser = argparse.ArgumentParser(description = "Map reads against a reference ge
 
 # Define some options/arguments/parameters
 parser.add_argument("-d", "--input_dir",
-                    help = "Directory containing trimmed paired fastq files to map. Note that the structure of input directory should be as follow: input_dir/{input_dir_1.fastq.gz, input_dir_2.fastq.gz}",
+                    help = "Directories containing trimmed paired fastq files to map. Note that the structure of input directories should be as follow: input_dir/{input_dir_1.fastq.gz, input_dir_2.fastq.gz}",
+                    nargs = "+",
                     required = True)
 
 parser.add_argument("-i", "--genome_index_directory",
@@ -56,6 +64,21 @@ parser.add_argument("-o", "--output_dir",
                     help = "Name of the output directory.",
                     required = True)
 
+parser.add_argument("-t", "--threads",
+                    type = int,
+                    help = "Total number of threads, shared by the samples aligned at the same time. Default: 15",
+                    default = 15)
+
+parser.add_argument("-j", "--jobs",
+                    type = int,
+                    help = "Number of samples aligned at the same time against the shared genome. Default: 1",
+                    default = 1)
+
+parser.add_argument("--limit_bam_sort_ram",
+                    type = int,
+                    help = "Maximum memory (in bytes) for sorting the bam file of each sample, when the genome is shared. Default: 10000000000",
+                    default = 10000000000)
+
 # This line checks if the user gave no arguments, and if so then print the help
 parser.parse_args(args = None if sys.argv[1:] else ["--help"])
 
@@ -71,7 +94,7 @@ args = parser.parse_args()
 def index_genome(genomedir, genomefasta, genomegtf):
     try:
         starindex_process = subprocess.run("STAR --runMode genomeGenerate "
-                                             "--runThreadN 15 "
+                                             f"--runThreadN {args.threads} "
                                              f"--genomeDir {genomedir} "
                                              f"--genomeFastaFiles {genomefasta} "
                                              f"--sjdbGTFfile {genomegtf}",
@@ -83,15 +106,40 @@ def index_genome(genomedir, genomefasta, genomegtf):
     except subprocess.CalledProcessError as err:
         print("An error occured:", err.stderr)
 
-def map_reads(genomedir, readfiles, genomegtf, output_prefix):
+# Function to load the genome index into shared memory, or to remove it, given the genome load option of STAR
+# (LoadAndExit or Remove)
+def manage_shared_genome(genomedir, genome_load):
+    try:
+        star_process = subprocess.run("STAR "
+                                      f"--genomeDir {genomedir} "
+                                      f"--genomeLoad {genome_load} "
+                                      f"--outFileNamePrefix {args.output_dir}/genome{genome_load}_",
+                                      shell = True,
+                                      capture_output = True,
+                                      text = True)
+
+        star_process.check_returncode()
+        return True
+
+    except subprocess.CalledProcessError as err:
+        print("An error occured:", err)
+        return False
+
+# Function to map reads, either loading the genome index (with the annotation) or using the genome already loaded into
+# shared memory
+def map_reads(genomedir, readfiles, genomegtf, output_prefix, threads, shared_genome = False):
+    if shared_genome:
+        genome_options = f"--genomeLoad LoadAndKeep --limitBAMsortRAM {args.limit_bam_sort_ram} "
+    else:
+        genome_options = f"--sjdbGTFfile {genomegtf} "
 
     try:
         star_process = subprocess.run("STAR --runMode alignReads "
-                                "--runThreadN 15 "
+                                f"--runThreadN {threads} "
                                 f"--genomeDir {genomedir} "
                                 f"--readFilesIn {readfiles} "
                                 "--readFilesCommand zcat "
-                                f"--sjdbGTFfile {genomegtf} "
+                                f"{genome_options}"
                                 f"--outFileNamePrefix {output_prefix} "
                                 "--outSAMtype BAM Unsorted SortedByCoordinate",
                                 shell = True,
@@ -99,9 +147,30 @@ def map_reads(genomedir, readfiles, genomegtf, output_prefix):
                                 text = True)
         
         star_process.check_returncode()
+        return True
 
     except subprocess.CalledProcessError as err:
         print("An error occured:", err)
+        return False
+
+# Function to map the reads of a sample, given its input directory
+def map_sample(input_dir):
+    # Define a variable to store the accession number of your run
+    acc = os.path.basename(os.path.normpath(input_dir))
+    readfiles = os.path.normpath(input_dir) + "/*_paired.fastq.gz"
+    output_prefix = args.output_dir + "/" + acc + "_"
+
+    print(f"-- {acc} -- Mapping reads...", flush = True)
+    mapped = map_reads(args.genome_index_directory, readfiles, args.reference_annotation, output_prefix, THREADS_PER_JOB, SHARED_GENOME)
+    if mapped:
+        print(f"-- {acc} -- Done", flush = True)
+
+    return acc, mapped
+
+# Function to turn a SIGTERM (e.g., from a job scheduler) into an exception, so that the genome is removed from shared
+# memory before exiting
+def handle_sigterm(signum, frame):
+    sys.exit(f"Terminated by signal {signum}")
 
 
 
@@ -154,24 +223,34 @@ else:
 #     Map reads     #
 #####################
 
-# Define a variable to store the accession number of your run
-if not os.path.basename(args.input_dir):
-    ACC = os.path.basename(args.input_dir[:-1])
-else:
-    ACC = os.path.basename(args.input_dir)
+# The genome is shared when several samples are aligned
+SHARED_GENOME = len(args.input_dir) > 1
+JOBS = max(1, min(args.jobs, len(args.input_dir)))
+THREADS_PER_JOB = max(1, args.threads // JOBS)
 
 print()
-print(f"-- {ACC} --")
+if SHARED_GENOME:
+    print("Loading the genome into shared memory...")
+    if not manage_shared_genome(args.genome_index_directory, "LoadAndExit"):
+        sys.exit(1)
 
-if args.input_dir.endswith("/"):
-    READFILES = args.input_dir + "*_paired.fastq.gz"
-else:
-    READFILES = args.input_dir + "/*_paired.fastq.gz"
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+try:
+    with ThreadPoolExecutor(max_workers = JOBS) as executor:
+        results = list(executor.map(map_sample, args.input_dir))
 
-OUTPUT_PREFIX = args.output_dir + "/" + ACC + "_"
+finally:
+    if SHARED_GENOME:
+        print("Removing the genome from shared memory...")
+        manage_shared_genome(args.genome_index_directory, "Remove")
 
-print("  Mapping reads...")
-map_reads(args.genome_index_directory, READFILES, args.reference_annotation, OUTPUT_PREFIX)
+failed_samples = [acc for acc, mapped in results if not mapped]
+
+print()
+print(f"Mapped {len(results) - len(failed_samples)} out of {len(results)} samples")
+if failed_samples:
+    print("Failed samples: " + ", ".join(failed_samples))
+    sys.exit(1)
 
-print("Done")
 print()
@@ -1,6 +1,6 @@
 #!/bin/env python3
 
-# Given a directory containing paired fastq files, this script trim reads using trimmomatic.
+# Given one or more directories containing paired fastq files, this script trim reads using trimmomatic.
 # REQUIRED SOFTWARES: trimmomatic, fastqc
 #
 # Note that the structure of input directory should be as follow:
@@ -32,12 +32,33 @@
 #         ├── SRRXXXXXXN_2_paired.fastq.gz
 #         └── SRRXXXXXXN_2_unpaired.fastq.gz
 #
+# Several directories can be given at once. Trimmomatic and fastqc jobs of all the samples are then scheduled against a
+# total number of cores (--cores, by default the cores this process is allowed to run on, taking into account the CPU
+# limits of its cgroup), which is split across the concurrent trimmomatic jobs (--jobs).
+#
+# With --engine native, reads are trimmed in-process with NumPy instead of trimmomatic, one core per sample. The native
+# engine applies the same LEADING:5 TRAILING:5 SLIDINGWINDOW:4:15 MINLEN:65 steps over batches of reads, and writes the
+# same paired/unpaired files. Note that adapters are NOT clipped (there is no ILLUMINACLIP step).
+# REQUIRED SOFTWARES for --engine native: numpy
+#
+# With --qc_stats (native engine only), QC statistics are collected while reads are trimmed, without reading the
+# output files again: read counts before and after trimming, and, for raw reads and for reads in the paired files,
+# length and GC histograms, per-position quality distribution and base composition. They are written in
+# 01_fastqc/, as SRRXXXXXX_qc.json (all the statistics), SRRXXXXXX_qc_summary.tsv and SRRXXXXXX_qc_positions.tsv.
+# In that case, fastqc can be skipped with --skip_fastqc.
+#
 #
 # Written by:   Filippo Nicolini
-# Last updated: 09/10/2023
+# Last updated: 18/10/2026
+
 
+import subprocess, argparse, sys, os, threading, multiprocessing, gzip, glob, itertools, json, zlib
+from concurrent.futures import ThreadPoolExecutor
 
-import subprocess, argparse, sys, os
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 ############################################
@@ -50,57 +71,443 @@ parser = argparse.ArgumentParser(description = "Trim reads using Trimmomatic and
 # Define some options/arguments/parameters
 parser.add_argument("-d", "--input_dir",
                     required = True,
-                    help = "Directory containing paired fastq files to trim. Note that the structure of input directory should be as follow: input_dir/{input_dir_1.fastq.gz, input_dir_2.fastq.gz}")
+                    nargs = "+",
+                    help = "Directories containing paired fastq files to trim. Note that the structure of input directories should be as follow: input_dir/{input_dir_1.fastq.gz, input_dir_2.fastq.gz}")
 
 parser.add_argument("-a", "--illumina_adapters",
-                    required = True,
-                    help = "File containing Illumina adapters.")
+                    help = "File containing Illumina adapters. Required with --engine trimmomatic.")
 
 parser.add_argument("-o", "--output_dir",
                     help = "Name of the output directory.",
                     default = "02_trimmed_reads")
 
+parser.add_argument("-c", "--cores",
+                    type = int,
+                    help = "Total number of cores to use. Default: cores available to this process (CPU affinity and cgroup limits)",
+                    default = None)
+
+parser.add_argument("-j", "--jobs",
+                    type = int,
+                    help = "Number of samples to trim at the same time, sharing the cores. Default: one every 8 cores (one per core with --engine native)",
+                    default = None)
+
+parser.add_argument("-e", "--engine",
+                    choices = ["trimmomatic", "native"],
+                    help = "Trimming engine: trimmomatic, or the built-in NumPy engine (no adapter clipping). Default: trimmomatic",
+                    default = "trimmomatic")
+
+parser.add_argument("--compression_level",
+                    type = int,
+                    choices = range(1, 10),
+                    help = "Gzip compression level of the files written by the native engine (most of its run time is spent compressing). Default: 6, as trimmomatic",
+                    default = 6)
+
+parser.add_argument("--qc_stats",
+                    action = "store_true",
+                    help = "Collect QC statistics while trimming (only with --engine native). Default: False",
+                    default = False)
+
+parser.add_argument("--skip_fastqc",
+                    action = "store_true",
+                    help = "Do not run fastqc on the trimmed reads. Default: False",
+                    default = False)
+
 # This line checks if the user gave no arguments, and if so then print the help
 parser.parse_args(args = None if sys.argv[1:] else ["--help"])
 
 # Collect the inputted arguments into a dictionary
 args = parser.parse_args()
 
+if args.engine == "trimmomatic" and not args.illumina_adapters:
+    parser.error("-a/--illumina_adapters is required with --engine trimmomatic")
+
+if args.engine == "native" and np is None:
+    sys.exit("ERROR: --engine native requires numpy")
+
+if args.qc_stats and args.engine != "native":
+    parser.error("--qc_stats requires --engine native")
+
+
+# Trimming steps, shared by trimmomatic and the native engine
+LEADING_QUALITY = 5
+TRAILING_QUALITY = 5
+WINDOW_SIZE = 4
+WINDOW_QUALITY = 15
+MIN_LENGTH = 65
+
+# Number of read pairs trimmed at a time by the native engine, and size of the chunks fastq files are decompressed in
+NATIVE_BATCH_SIZE = 50000
+FASTQ_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Phred scores counted by the QC statistics (phred33 characters from "!" to "~"), and code of each base (A, C, G, T, N)
+MAX_QUALITY = 93
+BASES = "ACGTN"
+if np is not None:
+    BASE_CODES = np.full(256, 4, dtype = np.uint8)
+    for code, base in enumerate("ACGT"):
+        BASE_CODES[ord(base)] = BASE_CODES[ord(base.lower())] = code
+
 
 ##############################
 #     Defining functions     #
 ##############################
 
+# Function to get the number of cores available to this process: the CPUs it can be scheduled on, capped by the CPU
+# quota of its cgroup (cgroup v2 cpu.max, or cgroup v1 cpu.cfs_quota_us/cpu.cfs_period_us), if any
+def get_available_cores():
+    cores = len(os.sched_getaffinity(0))
+
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as cpu_max:
+            quota, period = cpu_max.read().split()
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as quota_file, open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as period_file:
+                quota, period = quota_file.read().strip(), period_file.read().strip()
+        except OSError:
+            quota, period = "max", "1"
+
+    if quota not in ("max", "-1"):
+        cores = min(cores, max(1, int(int(quota) / int(period))))
+
+    return cores
+
+
+# Functions to take and give back cores from the total budget, blocking until enough cores are free
+core_condition = threading.Condition()
+
+def acquire_cores(n_cores):
+    with core_condition:
+        core_condition.wait_for(lambda: free_cores[0] >= n_cores)
+        free_cores[0] -= n_cores
+
+
+def release_cores(n_cores):
+    with core_condition:
+        free_cores[0] += n_cores
+        core_condition.notify_all()
+
+
+# Function to print a message about a sample (samples are processed at the same time)
+print_lock = threading.Lock()
+
+def log(acc, message):
+    with print_lock:
+        print(f"-- {acc} -- {message}")
+
+
 # Function to trim reads, given a directory containing paired fastq files
-def trim_reads(input_directory, acc, trim_output_dir):
-    subprocess.run(f"mkdir {trim_output_dir}", shell = True)
+def trim_reads(input_directory, acc, trim_output_dir, threads):
+    subprocess.run(f"mkdir -p {trim_output_dir}", shell = True)
 
     try:
-        trimmomatic_process = subprocess.run(f"trimmomatic PE -threads 15 -phred33 "
+        trimmomatic_process = subprocess.run(f"trimmomatic PE -threads {threads} -phred33 "
                                              f"{input_directory}/{acc}*1.fastq.gz {input_directory}/{acc}*2.fastq.gz "
                                              f"{trim_output_dir}/{acc}_1_paired.fastq.gz {trim_output_dir}/{acc}_1_unpaired.fastq.gz "
                                              f"{trim_output_dir}/{acc}_2_paired.fastq.gz {trim_output_dir}/{acc}_2_unpaired.fastq.gz "
                                              f"ILLUMINACLIP:{args.illumina_adapters}:2:30:10 "
-                                             "LEADING:5 TRAILING:5 SLIDINGWINDOW:4:15 MINLEN:65 ",
+                                             f"LEADING:{LEADING_QUALITY} TRAILING:{TRAILING_QUALITY} "
+                                             f"SLIDINGWINDOW:{WINDOW_SIZE}:{WINDOW_QUALITY} MINLEN:{MIN_LENGTH} ",
                                              shell = True,
                                              capture_output = True,
                                              text = True)
         trimmomatic_process.check_returncode()
+        return True
         
     except subprocess.CalledProcessError as err:
         print("An error occured:", err.stderr)
+        return False
+
+# Function to read a gzipped fastq file in batches of reads.
+# The file is decompressed in large chunks that are split into lines at once, which is much faster than reading it
+# line by line. Yields the lists of headers, sequences and qualities of each batch.
+def read_fastq_batches(fastq_file, batch_size):
+    with gzip.open(fastq_file, "rb") as fastq:
+        lines, remainder = [], b""
+        for chunk in iter(lambda: fastq.read(FASTQ_CHUNK_SIZE), b""):
+            lines += (remainder + chunk).split(b"\n")
+            remainder = lines.pop()
+
+            while len(lines) >= 4 * batch_size:
+                batch = lines[:4 * batch_size]
+                del lines[:4 * batch_size]
+                yield [line.rstrip() for line in batch[0::4]], [line.rstrip() for line in batch[1::4]], [line.rstrip() for line in batch[3::4]]
+
+        if remainder:
+            lines.append(remainder)
+
+        if lines:
+            yield [line.rstrip() for line in lines[0::4]], [line.rstrip() for line in lines[1::4]], [line.rstrip() for line in lines[3::4]]
+
+
+# Function to find the part of each read to keep, given their quality strings (phred33).
+# Steps follow the trimmomatic trimmers:
+#   * LEADING/TRAILING: remove bases below the quality threshold from the start/end of the read;
+#   * SLIDINGWINDOW: cut the read at the first window (from the 5' end) whose mean quality is below the threshold,
+#     keeping the bases of that window before its first low quality base. Reads shorter than the window are
+#     dropped when their mean quality is below the threshold;
+#   * MINLEN: drop reads shorter than the minimum length.
+# Reads are stored in a zero-padded matrix, so that each step works on the whole batch at once.
+# Returns the start and end positions of each read, and whether the read is kept.
+def get_trimming_positions(quals):
+    n_reads = len(quals)
+    lengths = np.fromiter(map(len, quals), dtype = np.int64, count = n_reads)
+    max_length = max(int(lengths.max()), WINDOW_SIZE)
+    rows = np.arange(n_reads)
+
+    in_read = np.arange(max_length) < lengths[:, None]
+    phred = np.zeros((n_reads, max_length), dtype = np.int32)
+    phred[in_read] = np.frombuffer(b"".join(quals), dtype = np.uint8)
+    phred = np.maximum(phred - 33, 0) * in_read
+
+    # LEADING and TRAILING
+    leading_good = in_read & (phred >= LEADING_QUALITY)
+    trailing_good = in_read & (phred >= TRAILING_QUALITY)
+    keep = leading_good.any(axis = 1) & trailing_good.any(axis = 1)
+    starts = leading_good.argmax(axis = 1)
+    ends = max_length - trailing_good[:, ::-1].argmax(axis = 1)
+    keep &= ends > starts
+    ends = np.where(keep, ends, starts)
+
+    # SLIDINGWINDOW, with window sums computed from the cumulative qualities
+    cumulative = np.zeros((n_reads, max_length + 1), dtype = np.int64)
+    np.cumsum(phred, axis = 1, out = cumulative[:, 1:])
+    window_sums = cumulative[:, WINDOW_SIZE:] - cumulative[:, :-WINDOW_SIZE]
+    window_starts = np.arange(max_length - WINDOW_SIZE + 1)
+
+    in_trimmed_read = (window_starts >= starts[:, None]) & (window_starts + WINDOW_SIZE <= ends[:, None])
+    failing = in_trimmed_read & (window_sums < WINDOW_QUALITY * WINDOW_SIZE)
+    has_failing = failing.any(axis = 1)
+    first_failing = failing.argmax(axis = 1)
+
+    # Extend the cut over the good bases at the start of the failing window
+    still_good = np.ones(n_reads, dtype = bool)
+    extension = np.zeros(n_reads, dtype = np.int64)
+    for offset in range(WINDOW_SIZE):
+        still_good &= phred[rows, first_failing + offset] >= WINDOW_QUALITY
+        extension += still_good
+
+    ends = np.where(has_failing, first_failing + extension, ends)
+    keep &= ends > starts
+
+    short = keep & (ends - starts < WINDOW_SIZE) & ~has_failing
+    short_too_low = (cumulative[rows, ends] - cumulative[rows, starts]) < WINDOW_QUALITY * (ends - starts)
+    keep &= ~(short & short_too_low)
+
+    # MINLEN
+    keep &= ends - starts >= MIN_LENGTH
+
+    return starts, ends, keep
+
+
+# Function to write the trimmed reads selected by a boolean mask to a fastq file
+def write_fastq_records(fastq, headers, seqs, quals, starts, ends, selected):
+    starts, ends = starts.tolist(), ends.tolist()
+    fastq.write(b"".join(headers[i] + b"\n" + seqs[i][starts[i]:ends[i]] + b"\n+\n" + quals[i][starts[i]:ends[i]] + b"\n"
+                         for i in np.flatnonzero(selected).tolist()))
+
+
+# Function to add counts to an array of QC statistics, padding them with zeros along the first axis (e.g., read
+# positions) if needed
+def add_counts(counts, new_counts):
+    if len(new_counts) > len(counts):
+        counts, new_counts = new_counts, counts
+
+    counts[:len(new_counts)] += new_counts
+    return counts
+
+
+# Function to initialise the QC statistics of a set of reads
+def new_read_stats():
+    return {"reads": 0,
+            "bases": 0,
+            "length_histogram": np.zeros(0, dtype = np.int64),
+            "gc_histogram": np.zeros(101, dtype = np.int64),
+            "position_quality": np.zeros((0, MAX_QUALITY + 1), dtype = np.int64),
+            "position_bases": np.zeros((0, len(BASES)), dtype = np.int64)}
+
+
+# Function to add the trimmed reads selected by a boolean mask to the QC statistics.
+# Bases and qualities of all the reads are concatenated in two arrays, together with the read position of each base,
+# so that every statistic is a single bincount (or reduceat, for per-read counts).
+def collect_read_stats(stats, seqs, quals, starts, ends, selected):
+    indices = np.flatnonzero(selected)
+    lengths = ends[indices] - starts[indices]
+    if not lengths.sum():
+        return
+
+    boundaries = list(zip(indices.tolist(), starts[indices].tolist(), ends[indices].tolist()))
+    bases = BASE_CODES[np.frombuffer(b"".join(seqs[i][start:end] for i, start, end in boundaries), dtype = np.uint8)]
+    qualities = np.frombuffer(b"".join(quals[i][start:end] for i, start, end in boundaries), dtype = np.uint8)
+    qualities = np.maximum(qualities, 33) - 33
+
+    max_length = int(lengths.max())
+    offsets = np.cumsum(lengths) - lengths
+    positions = np.arange(len(bases)) - np.repeat(offsets, lengths)
+
+    non_empty = lengths > 0
+    gc_counts = np.add.reduceat(((bases == 1) | (bases == 2)).astype(np.int64), offsets[non_empty])
+    gc_percentages = np.round(100 * gc_counts / lengths[non_empty]).astype(np.int64)
+
+    stats["reads"] += len(indices)
+    stats["bases"] += int(lengths.sum())
+    stats["length_histogram"] = add_counts(stats["length_histogram"], np.bincount(lengths))
+    stats["gc_histogram"] += np.bincount(gc_percentages, minlength = 101)
+    stats["position_quality"] = add_counts(stats["position_quality"],
+                                           np.bincount(positions * (MAX_QUALITY + 1) + qualities, minlength = max_length * (MAX_QUALITY + 1)).reshape(max_length, MAX_QUALITY + 1))
+    stats["position_bases"] = add_counts(stats["position_bases"],
+                                         np.bincount(positions * len(BASES) + bases, minlength = max_length * len(BASES)).reshape(max_length, len(BASES)))
+
+
+# Function to get a quantile of a distribution, given the counts of each value
+def get_quantile(counts, quantile):
+    return int(np.searchsorted(np.cumsum(counts), quantile * counts.sum()))
+
+
+# Function to write the QC statistics of a sample as json (all the statistics) and tsv (summary and per position) files
+def write_qc_stats(qc_stats, acc, qc_output_dir):
+    with open(f"{qc_output_dir}/{acc}_qc.json", "w") as json_file:
+        json.dump(qc_stats, json_file, indent = 1, default = lambda array: array.tolist())
+
+    with open(f"{qc_output_dir}/{acc}_qc_summary.tsv", "w") as summary_file, open(f"{qc_output_dir}/{acc}_qc_positions.tsv", "w") as positions_file:
+        summary_file.write("read\tset\treads\tbases\tmean_length\tmean_quality\tq30_bases_%\tgc_%\n")
+        positions_file.write("read\tset\tposition\treads\tmean_quality\tlower_quartile\tmedian\tupper_quartile\t" + "\t".join(f"{base}_%" for base in BASES) + "\n")
+
+        for mate in ("1", "2"):
+            for read_set in ("raw", "paired"):
+                stats = qc_stats[mate][read_set]
+                quality_counts = stats["position_quality"].sum(axis = 0)
+                base_counts = stats["position_bases"].sum(axis = 0)
+                bases = max(stats["bases"], 1)
+
+                summary_file.write(f"{mate}\t{read_set}\t{stats['reads']}\t{stats['bases']}\t"
+                                   f"{stats['bases'] / max(stats['reads'], 1):.2f}\t"
+                                   f"{(quality_counts * np.arange(MAX_QUALITY + 1)).sum() / bases:.2f}\t"
+                                   f"{quality_counts[30:].sum() / bases * 100:.2f}\t"
+                                   f"{base_counts[1:3].sum() / bases * 100:.2f}\n")
+
+                for position, (quality_counts, base_counts) in enumerate(zip(stats["position_quality"], stats["position_bases"])):
+                    reads = quality_counts.sum()
+                    positions_file.write(f"{mate}\t{read_set}\t{position + 1}\t{reads}\t"
+                                         f"{(quality_counts * np.arange(MAX_QUALITY + 1)).sum() / reads:.2f}\t"
+                                         f"{get_quantile(quality_counts, 0.25)}\t{get_quantile(quality_counts, 0.5)}\t{get_quantile(quality_counts, 0.75)}\t" +
+                                         "\t".join(f"{count / reads * 100:.2f}" for count in base_counts) + "\n")
+
+
+# Function to trim reads with the native engine, given a directory containing paired fastq files.
+# Pairs where both reads survive go to the paired files, pairs where only one survives to the unpaired ones.
+# With --qc_stats, QC statistics are collected on each batch and written once the sample is done.
+def trim_reads_native(input_directory, acc, trim_output_dir):
+    os.makedirs(trim_output_dir, exist_ok = True)
+
+    try:
+        fastq_1 = glob.glob(f"{input_directory}/{acc}*1.fastq.gz")[0]
+        fastq_2 = glob.glob(f"{input_directory}/{acc}*2.fastq.gz")[0]
+
+        output_names = ["1_paired", "1_unpaired", "2_paired", "2_unpaired"]
+        outputs = {name: gzip.open(f"{trim_output_dir}/{acc}_{name}.fastq.gz", "wb", compresslevel = args.compression_level) for name in output_names}
+
+        read_counts = {"input_pairs": 0, "paired": 0, "1_unpaired": 0, "2_unpaired": 0, "dropped": 0}
+        qc_stats = {mate: {"raw": new_read_stats(), "paired": new_read_stats()} for mate in ("1", "2")}
+
+        try:
+            for batch_1, batch_2 in itertools.zip_longest(read_fastq_batches(fastq_1, NATIVE_BATCH_SIZE),
+                                                          read_fastq_batches(fastq_2, NATIVE_BATCH_SIZE)):
+                if batch_1 is None or batch_2 is None or len(batch_1[0]) != len(batch_2[0]):
+                    raise ValueError(f"{fastq_1} and {fastq_2} do not contain the same number of reads")
+
+                starts_1, ends_1, keep_1 = get_trimming_positions(batch_1[2])
+                starts_2, ends_2, keep_2 = get_trimming_positions(batch_2[2])
+
+                write_fastq_records(outputs["1_paired"], *batch_1, starts_1, ends_1, keep_1 & keep_2)
+                write_fastq_records(outputs["1_unpaired"], *batch_1, starts_1, ends_1, keep_1 & ~keep_2)
+                write_fastq_records(outputs["2_paired"], *batch_2, starts_2, ends_2, keep_1 & keep_2)
+                write_fastq_records(outputs["2_unpaired"], *batch_2, starts_2, ends_2, ~keep_1 & keep_2)
+
+                if args.qc_stats:
+                    read_counts["input_pairs"] += len(keep_1)
+                    read_counts["paired"] += int((keep_1 & keep_2).sum())
+                    read_counts["1_unpaired"] += int((keep_1 & ~keep_2).sum())
+                    read_counts["2_unpaired"] += int((~keep_1 & keep_2).sum())
+                    read_counts["dropped"] += int((~keep_1 & ~keep_2).sum())
+
+                    for mate, (headers, seqs, quals), starts, ends in (("1", batch_1, starts_1, ends_1), ("2", batch_2, starts_2, ends_2)):
+                        lengths = np.fromiter(map(len, seqs), dtype = np.int64, count = len(seqs))
+                        collect_read_stats(qc_stats[mate]["raw"], seqs, quals, np.zeros_like(lengths), lengths, np.ones(len(seqs), dtype = bool))
+                        collect_read_stats(qc_stats[mate]["paired"], seqs, quals, starts, ends, keep_1 & keep_2)
+
+        finally:
+            [output.close() for output in outputs.values()]
+
+        if args.qc_stats:
+            write_qc_stats({"sample": acc, "read_counts": read_counts, **qc_stats}, acc, f"{args.output_dir}/01_fastqc")
+
+        return True
+
+    # Truncated or corrupted gzip files raise EOFError or zlib.error
+    except (OSError, IndexError, ValueError, EOFError, zlib.error) as err:
+        print("An error occured:", err)
+        return False
+
 
 # Function to perform the quality check, given the fastq file
-def quality_check(fastq_file):
+def quality_check(fastq_file, threads):
     try:
-        fastqc_process = subprocess.run(f"fastqc {fastq_file} -o {args.output_dir}/01_fastqc -f fastq",
+        fastqc_process = subprocess.run(f"fastqc -t {threads} {fastq_file} -o {args.output_dir}/01_fastqc -f fastq",
                                         shell = True,
                                         capture_output = True,
                                         text = True)
         fastqc_process.check_returncode()
+        return True
 
     except subprocess.CalledProcessError as err:
         print("An error occured:", err.stderr)
+        return False
+
+
+# Function to trim and check the reads of a sample, given its input directory.
+# Trimmomatic runs on a share of the cores (the native engine on one core, in a worker process), while fastqc only
+# needs one core per fastq file. Fastqc is skipped with --skip_fastqc.
+def process_sample(input_directory):
+    # Define a variable to store accession number of your run
+    acc = os.path.basename(os.path.normpath(input_directory))
+
+    # Define a variable to store the name of the output directory of trimmed reads
+    trim_output_dir = args.output_dir + "/" + acc + "_trimmed"
+
+    acquire_cores(TRIM_THREADS)
+    try:
+        log(acc, f"Trimming reads ({TRIM_THREADS} threads)...")
+        if args.engine == "native":
+            # Any other error in the worker process only makes this sample fail
+            try:
+                trimmed = native_pool.apply(trim_reads_native, (input_directory, acc, trim_output_dir))
+            except Exception as err:
+                log(acc, f"An error occured: {err}")
+                trimmed = False
+        else:
+            trimmed = trim_reads(input_directory, acc, trim_output_dir, TRIM_THREADS)
+    finally:
+        release_cores(TRIM_THREADS)
+
+    if not trimmed:
+        return acc, False
+
+    if args.skip_fastqc:
+        log(acc, "Done")
+        return acc, True
+
+    acquire_cores(QC_THREADS)
+    try:
+        log(acc, "Checking read quality...")
+        checked = quality_check(trim_output_dir + "/*_paired.fastq.gz", QC_THREADS)
+    finally:
+        release_cores(QC_THREADS)
+
+    if checked:
+        log(acc, "Done")
+
+    return acc, checked
 
 
 #------------------------------------------------------------------------------------------
@@ -110,14 +517,16 @@ def quality_check(fastq_file):
 #     Trim read and perform quality check     #
 ###############################################
 
-# Define a variable to store accession number of your run
-if not os.path.basename(args.input_dir):
-    ACC = os.path.basename(args.input_dir[:-1])
+# Split the core budget across the samples trimmed at the same time
+TOTAL_CORES = args.cores if args.cores else get_available_cores()
+if args.engine == "native":
+    JOBS = args.jobs if args.jobs else TOTAL_CORES
 else:
-    ACC = os.path.basename(args.input_dir)
-
-# Define a variable to store the name of the output directory of trimmed reads
-TRIM_OUTPUT_DIR = args.output_dir + "/" + ACC + "_trimmed"
+    JOBS = args.jobs if args.jobs else max(1, TOTAL_CORES // 8)
+JOBS = max(1, min(JOBS, len(args.input_dir), TOTAL_CORES))
+TRIM_THREADS = 1 if args.engine == "native" else TOTAL_CORES // JOBS
+QC_THREADS = min(2, TOTAL_CORES)
+free_cores = [TOTAL_CORES]
 
 # Create output direcotory
 if not os.path.isdir(args.output_dir):
@@ -125,16 +534,30 @@ if not os.path.isdir(args.output_dir):
     print(f"Creating output directory in {args.output_dir}/")
     subprocess.run(f"mkdir -p {args.output_dir}/01_fastqc", shell = True)
 
-# Trim reads
+# Trim reads and check their quality
 print()
-print(f"-- {ACC} --")
-print("  Trimming reads...")
-trim_reads(args.input_dir, ACC, TRIM_OUTPUT_DIR)
+print(f"Processing {len(args.input_dir)} samples on {TOTAL_CORES} cores ({JOBS} {args.engine} jobs of {TRIM_THREADS} threads at a time)")
+print()
+
+# The native engine runs in worker processes, forked before any thread is started
+if args.engine == "native":
+    native_pool = multiprocessing.get_context("fork").Pool(JOBS)
+
+try:
+    with ThreadPoolExecutor(max_workers = TOTAL_CORES) as executor:
+        results = list(executor.map(process_sample, args.input_dir))
 
-# Quality check
-FASTQ_file = args.output_dir + "/" + ACC + "_trimmed/*_paired.fastq.gz"
-print("  Checking read quality...")
-quality_check(FASTQ_file)
+finally:
+    if args.engine == "native":
+        native_pool.close()
+        native_pool.join()
+
+failed_samples = [acc for acc, succeeded in results if not succeeded]
+
+print()
+print(f"Processed {len(results) - len(failed_samples)} out of {len(results)} samples")
+if failed_samples:
+    print("Failed samples: " + ", ".join(failed_samples))
+    sys.exit(1)
 
-print("Done")
 print()